@@ -0,0 +1,137 @@
+# encoding: utf-8
+
+'''
+Benchmarks the hydroweb TXT parser (utils/parsing.py) against the former line-by-line implementation, on synthetic
+v1 and v2 files.
+Run from the app folder: python -m benchmarks.parsing
+'''
+
+import argparse
+import random
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from os import path
+
+from utils import parsing
+
+
+def write_txt_file(filepath, version, rows, seed=0):
+    """
+    Write a synthetic hydroweb TXT file
+    :param filepath:
+    :param version: parsing.HYDROWEB_v1 or parsing.HYDROWEB_v2
+    :param rows: number of observations
+    :param seed: random seed
+    :return:
+    """
+    rnd = random.Random(seed)
+    date = datetime(1992, 9, 27)
+    with open(filepath, 'w') as file:
+        if version == parsing.HYDROWEB_v2:
+            file.write('#BASIN:: NIGER\n#RIVER:: NIGER\n#ID:: {id}\n#REFERENCE LONGITUDE:: {lon:.4f}\n'
+                       '#REFERENCE LATITUDE:: {lat:.4f}\n#STATUS:: operational\n#PRODUCT VERSION:: 2.0\n#\n'
+                       '#COL 1 : DATE(YYYY-MM-DD)\n#COL 2 : TIME(HH:MM)\n#COL 3 : ORTHOMETRIC HEIGHT (M)\n'
+                       '#COL 4 : ASSOCIATED UNCERTAINTY(M)\n'.format(id=path.splitext(path.basename(filepath))[0],
+                                                                  lon=rnd.uniform(-5, 15), lat=rnd.uniform(4, 17)))
+        else:
+            file.write('lake={id};country=Nigeria;basin=Niger;lat={lat:.4f};lon={lon:.4f};date=2020/01/01;'
+                       'type=research\n'.format(id=path.splitext(path.basename(filepath))[0],
+                                                lon=rnd.uniform(-5, 15), lat=rnd.uniform(4, 17)))
+        for i in range(rows):
+            date += timedelta(days=rnd.randint(1, 10), minutes=rnd.randint(0, 1439))
+            h = 250 + 5 * rnd.random()
+            u = rnd.random()
+            if version == parsing.HYDROWEB_v2:
+                file.write('{} {} {:.3f} {:.3f} 0.0 0.0\n'.format(date.strftime('%Y-%m-%d'), date.strftime('%H:%M'),
+                                                                   h, u))
+            else:
+                file.write('{:.8f} ; {} ; {} ; {:.3f} ; {:.3f} ; 1\n'.format(date.year + date.timetuple().tm_yday / 366,
+                                                                            date.strftime('%Y/%m/%d'),
+                                                                            date.strftime('%H:%M'), h, u))
+
+
+def line_by_line_txt2array(filepath):
+    '''
+    Former implementation of parsing.txt2array, kept as reference
+    '''
+    with open(filepath) as file:
+        line = file.readline()
+        file_version = parsing.HYDROWEB_v1
+        if line.lstrip().startswith('#'):
+            file_version = parsing.HYDROWEB_v2
+        line = file.readline()
+        data = []
+        while line:
+            if not line.lstrip().startswith('#'):
+                line_data = parsing._txt_parse_line_data(line, file_version)
+                data.append((line_data['timestamp_iso'],
+                             float(line_data['water_surface_height_above_reference_datum'])))
+            line = file.readline()
+    return data
+
+
+def line_by_line_txt2data_vectors(filepath):
+    '''
+    Former implementation of parsing.txt2data_vectors, kept as reference
+    '''
+    x, y = zip(*line_by_line_txt2array(filepath))
+    return {
+        'dates': x,
+        'h': y
+    }
+
+
+def run(rows_list, repeat):
+    """
+    :param rows_list: file sizes (number of observations) to benchmark
+    :param repeat: number of timed runs. The best one is kept
+    :return: list of result dicts
+    """
+    candidates = [
+        ('line-by-line txt2data_vectors', line_by_line_txt2data_vectors),
+        ('txt2series', parsing.txt2series),
+        ('txt2data_vectors', parsing.txt2data_vectors),
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for version in [parsing.HYDROWEB_v1, parsing.HYDROWEB_v2]:
+            for rows in rows_list:
+                filepath = path.join(tmp, '{}_{}.txt'.format(version, rows))
+                write_txt_file(filepath, version, rows)
+                # check the implementations agree before timing them
+                if list(parsing.txt2data_vectors(filepath)['dates']) != \
+                        list(line_by_line_txt2data_vectors(filepath)['dates']):
+                    raise AssertionError('parsers disagree on {}'.format(filepath))
+                reference = None
+                for name, fn in candidates:
+                    best = min(timeit.repeat(lambda: fn(filepath), number=1, repeat=repeat))
+                    reference = reference or best
+                    results.append({
+                        'version': version,
+                        'rows': rows,
+                        'function': name,
+                        'seconds': best,
+                        'speedup': reference / best,
+                    })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Benchmarks the hydroweb TXT parser against the former line-by-line implementation
+    ''')
+    parser.add_argument('-r', '--rows', help='comma-separated list of file sizes (number of observations)',
+                        default='10000,50000')
+    parser.add_argument('-n', '--repeat', help='number of timed runs (the best one is kept)', type=int, default=5)
+    args = parser.parse_args()
+
+    results = run([int(r) for r in args.rows.split(',')], args.repeat)
+    print('{:<8}{:>8}  {:<32}{:>10}{:>10}'.format('version', 'rows', 'function', 'ms', 'speedup'))
+    for r in results:
+        print('{:<8}{:>8}  {:<32}{:>10.1f}{:>9.1f}x'.format(r['version'], r['rows'], r['function'],
+                                                          r['seconds'] * 1000, r['speedup']))
+
+
+if __name__ == '__main__':
+    main()
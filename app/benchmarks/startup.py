@@ -0,0 +1,135 @@
+# encoding: utf-8
+
+'''
+Startup time of the API workers and of prepare_stations.py, checked against a time budget.
+
+Each target runs in fresh interpreters (the best of -n runs is kept), on a generated dataset (see
+suite.generate_dataset) prepared with prepare_stations.py, so that the API maps an actual merged catalog:
+ - api: what a uwsgi worker runs before serving its first request (main.py: app configuration, sources, views, merged
+   catalog mapping),
+ - prepare_stations: the import of scripts/prepare_stations.py.
+The process time (interpreter startup included) is compared to the budget: the command fails if a target exceeds it,
+so that it can run in CI. --importtime lists the slowest imports of every target (python -X importtime).
+Run from the app folder: python -m benchmarks.startup
+
+Only the thumbnail engines (matplotlib) are imported lazily, by prepare_stations.py. The imports of the api target are
+left eager: flask, numpy and the app modules are all used before the first request is served, and flask_compress, the
+only optional one, takes about 3 ms (configure_app calls it at startup anyway).
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.suite import APP_FOLDER, REPO_FOLDER, generate_dataset, _environment
+
+# target -> code run in a child process, printing the duration of the startup itself
+TARGETS = {
+    'api': 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)',
+    'prepare_stations': 'import sys, time; start = time.perf_counter(); sys.path.insert(0, {!r}); '
+                        'from app.scripts import prepare_stations; print(time.perf_counter() - start)'.format(
+                            REPO_FOLDER),
+}
+# target -> max process time, in seconds
+STARTUP_BUDGETS = {
+    'api': 0.5,
+    'prepare_stations': 0.6,
+}
+PREPARE = 'import sys; sys.path.insert(0, {!r}); from app.scripts import prepare_stations; prepare_stations.main()'.format(
+    REPO_FOLDER)
+
+
+def _run(code, env, options=()):
+    """
+    Run python code in a fresh interpreter, from the app folder
+    :return: (process time in seconds, completed process)
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable] + list(options) + ['-c', code], cwd=APP_FOLDER,
+                             env=dict(os.environ, **env), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return time.perf_counter() - start, process
+
+
+def measure(target, env, repeat):
+    """
+    :return: dict with the best process and startup times (seconds)
+    """
+    runs = []
+    for _ in range(repeat):
+        process_seconds, process = _run(TARGETS[target], env)
+        runs.append((process_seconds, float(process.stdout.decode().split()[-1])))
+    process_seconds, startup_seconds = min(runs)
+    return {'benchmark': 'startup[{}]'.format(target), 'seconds': process_seconds,
+            'startup_seconds': startup_seconds, 'repeat': repeat}
+
+
+def slowest_imports(target, env, n):
+    """
+    :return: the n imports of the target with the longest cumulated time, as (module, seconds) tuples
+    """
+    _, process = _run(TARGETS[target], env, ['-X', 'importtime'])
+    imports = []
+    for line in process.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda i: i[1], reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Startup time of the API workers and of prepare_stations.py, checked against a time budget
+    ''')
+    parser.add_argument('-s', '--stations', help='number of stations of the generated catalog', type=int, default=1000)
+    parser.add_argument('-n', '--repeat', help='number of timed runs (the best one is kept)', type=int, default=5)
+    parser.add_argument('-b', '--budget', action='append', default=[], metavar='TARGET=SECONDS',
+                        help='max process time of a target, overriding the default ({})'.format(
+                            ', '.join('{}={}'.format(k, v) for k, v in STARTUP_BUDGETS.items())))
+    parser.add_argument('--importtime', help='list the N slowest imports of every target', type=int, default=0,
+                        metavar='N')
+    parser.add_argument('-o', '--output', help='results file (JSON)')
+    args = parser.parse_args()
+
+    budgets = dict(STARTUP_BUDGETS)
+    for budget in args.budget:
+        target, seconds = budget.split('=', 1)
+        budgets[target] = float(seconds)
+
+    results = []
+    with tempfile.TemporaryDirectory() as storage_path:
+        sources_file = generate_dataset(storage_path, args.stations, 10)
+        env = {'STORAGE_PATH': storage_path, 'SOURCES_CONFIG_FILE': sources_file,
+               'METRICS_PATH': os.path.join(storage_path, 'metrics')}
+        # sparklines: the dataset is prepared quickly
+        subprocess.run([sys.executable, '-c', PREPARE, '-e', 'svg', '-t', '1'], cwd=APP_FOLDER,
+                       env=dict(os.environ, **env), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        for target in TARGETS:
+            result = measure(target, env, args.repeat)
+            result['stations'] = args.stations
+            result['budget_seconds'] = budgets.get(target)
+            results.append(result)
+            if args.importtime:
+                result['slowest_imports'] = slowest_imports(target, env, args.importtime)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'environment': _environment(), 'results': results}, file, indent=2)
+    over_budget = False
+    for r in results:
+        exceeded = r['budget_seconds'] is not None and r['seconds'] > r['budget_seconds']
+        over_budget = over_budget or exceeded
+        print('{:<30}{:>10.0f} ms process{:>10.0f} ms startup{:>10.0f} ms budget{}'.format(
+            r['benchmark'], r['seconds'] * 1000, r['startup_seconds'] * 1000, (r['budget_seconds'] or 0) * 1000,
+            '  OVER BUDGET' if exceeded else ''), file=sys.stderr)
+        for module, seconds in r.get('slowest_imports', []):
+            print('    {:<50}{:>10.1f} ms'.format(module, seconds * 1000), file=sys.stderr)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
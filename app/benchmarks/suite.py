@@ -0,0 +1,327 @@
+# encoding: utf-8
+
+'''
+Benchmark suite: parsing, catalog build (prepare_stations.py) and API endpoints, on synthetic hydroweb data.
+
+For each scale (number of stations), a storage folder is generated with v1 (lakes) and v2 (rivers) TXT files and a
+local source, then:
+ - the parsing stage times parsing.txt2geojson, txt2array and txt2series on single files of each size (--rows),
+ - the prepare stage times the prepare_stations.py steps (_generate_stations_list, _generate_series,
+   _generate_statistics, _generate_thumbnails on a sample of stations, _generate_merged_catalog),
+ - the api stage times the main endpoints through the Flask test client, on the prepared data.
+Each stage runs in its own process: prepare_stations.py and the API import the app module differently, and the app
+reads its configuration (STORAGE_PATH, SOURCES_CONFIG_FILE) at import.
+
+The results are written as JSON (-o), to be compared between commits (--compare).
+Run from the app folder: python -m benchmarks.suite -o results.json
+Production-like scale: python -m benchmarks.suite -s 100,1000,10000 -r 1000,10000,100000
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime, timezone
+from os import path
+
+APP_FOLDER = path.dirname(path.dirname(path.abspath(__file__)))
+REPO_FOLDER = path.dirname(APP_FOLDER)
+SOURCE_ID = 'benchmark'
+
+
+def _timed(fn, repeat):
+    """
+    :param fn: function to time
+    :param repeat: number of timed runs
+    :return: dict with the best and mean durations (seconds)
+    """
+    runs = timeit.repeat(fn, number=1, repeat=repeat)
+    return {'seconds': min(runs), 'mean_seconds': sum(runs) / len(runs), 'repeat': repeat}
+
+
+def _station_files(storage_path, stations, rows):
+    """
+    Generate the TXT files of the benchmark source: one v1 (lake) file for every 4 stations, v2 (river) files for the
+    other ones
+    :return: list of files
+    """
+    from benchmarks.parsing import write_txt_file
+    from utils import parsing
+
+    folder = path.join(storage_path, 'sources', SOURCE_ID, 'stations', 'txt')
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for i in range(stations):
+        if i % 4 == 0:
+            version, station_id = parsing.HYDROWEB_v1, 'L_bench_{:05d}'.format(i)
+        else:
+            version, station_id = parsing.HYDROWEB_v2, 'R_bench_{:05d}'.format(i)
+        filepath = path.join(folder, '{}.txt'.format(station_id))
+        write_txt_file(filepath, version, rows, seed=i)
+        files.append(filepath)
+    return files
+
+
+def generate_dataset(storage_path, stations, rows):
+    """
+    Generate a storage folder and its sources config file
+    :param storage_path: storage folder
+    :param stations: number of stations
+    :param rows: number of observations per station
+    :return: sources config file path
+    """
+    _station_files(storage_path, stations, rows)
+    sources_file = path.join(storage_path, 'sources.ini')
+    with open(sources_file, 'w') as file:
+        file.write('[sources]\n{id}\n\n[{id}]\nname= {id}\nlist_uri= default\ndetails_uri= default\n'.format(
+            id=SOURCE_ID))
+    return sources_file
+
+
+def stage_parsing(rows_list, repeat):
+    """
+    Time the TXT parsing functions on single files
+    :return: list of result dicts
+    """
+    from benchmarks.parsing import write_txt_file
+    from utils import parsing
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for version in [parsing.HYDROWEB_v1, parsing.HYDROWEB_v2]:
+            for rows in rows_list:
+                filepath = path.join(tmp, '{}_{}.txt'.format(version, rows))
+                write_txt_file(filepath, version, rows)
+                for name, fn in [('parsing.txt2geojson', parsing.txt2geojson),
+                                 ('parsing.txt2array', parsing.txt2array),
+                                 ('parsing.txt2series', parsing.txt2series)]:
+                    result = {'benchmark': name, 'version': version, 'rows': rows}
+                    result.update(_timed(lambda: fn(filepath), repeat))
+                    results.append(result)
+    return results
+
+
+def stage_prepare(repeat, thumbnails_sample):
+    """
+    Time the prepare_stations.py steps on the dataset given by the STORAGE_PATH and SOURCES_CONFIG_FILE environment
+    variables. Leaves the prepared data in place, for the api stage
+    :return: list of result dicts
+    """
+    # prepare_stations.py is imported as part of the app package (see its imports)
+    sys.path.insert(0, REPO_FOLDER)
+    from app.scripts import prepare_stations
+
+    prepare_stations.THUMBNAIL_WORKERS = 1
+    src = prepare_stations.app.sources[SOURCE_ID]
+    files = sorted(prepare_stations.glob.glob(
+        prepare_stations.io_helper.paths['stations.data'].format(source_id=SOURCE_ID, station_id='*')))
+    for key, folder in prepare_stations.io_helper.paths.items():
+        if key.endswith('.folder'):
+            os.makedirs(folder.format(source_id=SOURCE_ID), exist_ok=True)
+
+    steps = [
+        ('prepare_stations._generate_stations_list', lambda: prepare_stations._generate_stations_list(src, files)),
+        ('prepare_stations._generate_series', lambda: prepare_stations._generate_series(src, files)),
+        ('prepare_stations._generate_statistics', lambda: prepare_stations._generate_statistics(src, files)),
+    ]
+    for engine in sorted(prepare_stations.THUMBNAIL_ENGINES):
+        def generate_thumbnails(engine=engine):
+            prepare_stations.THUMBNAIL_ENGINE = engine
+            prepare_stations._generate_thumbnails(src, files[:thumbnails_sample])
+        steps.append(('prepare_stations._generate_thumbnails[{}]'.format(engine), generate_thumbnails))
+    steps.append(('prepare_stations._generate_merged_catalog',
+                  lambda: prepare_stations._generate_merged_catalog(prepare_stations.app.sources)))
+
+    results = []
+    for name, fn in steps:
+        result = {'benchmark': name, 'stations': len(files)}
+        if 'thumbnails' in name:
+            result['stations'] = min(len(files), thumbnails_sample)
+        result.update(_timed(fn, repeat))
+        results.append(result)
+    prepare_stations.THUMBNAIL_ENGINE = 'matplotlib'
+    return results
+
+
+def stage_api(repeat):
+    """
+    Time the API endpoints through the Flask test client, on the prepared dataset. The first request of each
+    endpoint (cold caches) is timed apart
+    :return: list of result dicts
+    """
+    sys.path.insert(0, APP_FOLDER)
+    from app import app, sources, io_helper
+    import views
+
+    client = app.test_client()
+    catalog = io_helper.resource_get(sources[SOURCE_ID], 'list')
+    station_ids = [f['properties']['productIdentifier'] for f in catalog['features']]
+    station = station_ids[len(station_ids) // 2]
+    feature = catalog['features'][len(station_ids) // 2]
+    lon, lat = feature['geometry']['coordinates'][:2]
+
+    # benchmark name -> url
+    urls = [
+        ('/api/v1/stations', '/api/v1/stations'),
+        ('/api/v1/stations?format=ndjson', '/api/v1/stations?format=ndjson'),
+        ('/api/v1/sources/<source_id>/stations', '/api/v1/sources/{}/stations'.format(SOURCE_ID)),
+        ('/api/v1/stations?bbox=<2x2 degrees>&limit=100',
+         '/api/v1/stations?bbox={},{},{},{}&limit=100'.format(lon - 1, lat - 1, lon + 1, lat + 1)),
+        ('/api/v1/stations?basin=niger&limit=100', '/api/v1/stations?basin=niger&limit=100'),
+        ('/api/v1/stations/<station_id>', '/api/v1/stations/{}'.format(station)),
+        ('/api/v1/sources/<source_id>/stations/<station_id>?scope=data',
+         '/api/v1/sources/{}/stations/{}?scope=data'.format(SOURCE_ID, station)),
+        ('/api/v1/sources/<source_id>/stations/<station_id>?scope=data&max_points=500',
+         '/api/v1/sources/{}/stations/{}?scope=data&max_points=500'.format(SOURCE_ID, station)),
+        ('/api/v1/sources/<source_id>/stations/<station_id>?scope=latest&n=10',
+         '/api/v1/sources/{}/stations/{}?scope=latest&n=10'.format(SOURCE_ID, station)),
+        ('/api/v1/sources/<source_id>/stations/<station_id>?scope=statistics',
+         '/api/v1/sources/{}/stations/{}?scope=statistics'.format(SOURCE_ID, station)),
+        ('/api/v1/stations/nearby/<station_id>', '/api/v1/stations/nearby/{}'.format(station)),
+        ('/api/v1/stations/latest', '/api/v1/stations/latest'),
+        ('/api/v1/stations/data?ids=<20 stations>', '/api/v1/stations/data?ids={}'.format(','.join(station_ids[:20]))),
+    ]
+    results = []
+    for name, url in urls:
+        headers = {'Accept-Encoding': 'gzip'}
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        body = response.get_data()
+        first = time.perf_counter() - start
+        result = {
+            'benchmark': 'GET {}'.format(name),
+            'stations': len(station_ids),
+            'status': response.status_code,
+            'bytes': len(body),
+            'first_seconds': first,
+        }
+        result.update(_timed(lambda: client.get(url, headers=headers).get_data(), repeat))
+        results.append(result)
+    return results
+
+
+def _run_stage(stage, args, env=None):
+    """
+    Run a stage in a child process
+    :return: the stage results
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        output = path.join(tmp, 'results.json')
+        command = [sys.executable, '-m', 'benchmarks.suite', '--stage', stage, '--stage_output', output] + args
+        subprocess.run(command, cwd=APP_FOLDER, env=dict(os.environ, **(env or {})), check=True,
+                       stdout=subprocess.DEVNULL)
+        with open(output) as file:
+            return json.load(file)
+
+
+def _environment():
+    """
+    :return: description of the benchmarked code and platform
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_FOLDER, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import numpy
+    return {
+        'commit': commit,
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def _result_key(result):
+    return tuple((k, result[k]) for k in ('benchmark', 'version', 'rows', 'stations', 'station_rows') if k in result)
+
+
+def compare(baseline_file, results_file):
+    """
+    Print the ratio of the timings of two results files
+    :param baseline_file: reference results
+    :param results_file: results to compare with the reference
+    :return:
+    """
+    with open(baseline_file) as file:
+        baseline = {_result_key(r): r for r in json.load(file)['results']}
+    with open(results_file) as file:
+        results = json.load(file)['results']
+    print('{:<72}{:>8}{:>12}{:>12}{:>9}'.format('benchmark', 'size', 'before ms', 'after ms', 'ratio'))
+    for r in results:
+        before = baseline.get(_result_key(r))
+        if before is None:
+            continue
+        print('{:<72}{:>8}{:>12.2f}{:>12.2f}{:>8.2f}x'.format(r['benchmark'][:72], r.get('stations', r.get('rows', '')),
+                                                             before['seconds'] * 1000, r['seconds'] * 1000,
+                                                             r['seconds'] / before['seconds']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Benchmark suite: parsing, catalog build and API endpoints, on synthetic hydroweb data
+    ''')
+    parser.add_argument('-s', '--stations', help='comma-separated list of catalog scales (number of stations)',
+                        default='100,1000')
+    parser.add_argument('--station_rows', help='number of observations per station of the catalogs', type=int,
+                        default=1000)
+    parser.add_argument('-r', '--rows', help='comma-separated list of file sizes (number of observations) of the '
+                                             'parsing stage', default='1000,10000,100000')
+    parser.add_argument('--thumbnails', help='number of stations whose thumbnails are rendered', type=int,
+                        default=20)
+    parser.add_argument('-n', '--repeat', help='number of timed runs (the best one is kept)', type=int, default=3)
+    parser.add_argument('-o', '--output', help='results file (JSON). Default: standard output')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'),
+                        help='compare two results files instead of running the benchmarks')
+    # child processes
+    parser.add_argument('--stage', help=argparse.SUPPRESS, choices=['parsing', 'prepare', 'api'])
+    parser.add_argument('--stage_output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.stage:
+        if args.stage == 'parsing':
+            results = stage_parsing([int(r) for r in args.rows.split(',')], args.repeat)
+        elif args.stage == 'prepare':
+            results = stage_prepare(args.repeat, args.thumbnails)
+        else:
+            results = stage_api(args.repeat)
+        with open(args.stage_output, 'w') as file:
+            json.dump(results, file)
+        return
+
+    common = ['-n', str(args.repeat)]
+    results = _run_stage('parsing', common + ['-r', args.rows])
+    for stations in [int(s) for s in args.stations.split(',')]:
+        with tempfile.TemporaryDirectory() as storage_path:
+            start = time.perf_counter()
+            sources_file = generate_dataset(storage_path, stations, args.station_rows)
+            print('generated {} stations in {:.1f}s'.format(stations, time.perf_counter() - start), file=sys.stderr)
+            env = {'STORAGE_PATH': storage_path, 'SOURCES_CONFIG_FILE': sources_file}
+            for stage, stage_args in [('prepare', ['--thumbnails', str(args.thumbnails)]), ('api', [])]:
+                for result in _run_stage(stage, common + stage_args, env):
+                    result['station_rows'] = args.station_rows
+                    results.append(result)
+
+    report = {'environment': _environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    for r in results:
+        print('{:<72}{:>8}{:>12.2f} ms'.format(r['benchmark'][:72], r.get('stations', r.get('rows', '')),
+                                                r['seconds'] * 1000), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,15 +12,45 @@ class BaseConfig(object):
     LOGGING_LEVEL = logging.INFO
     CACHE_TYPE = 'simple'
     COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/xml',
-                          'application/json', 'application/javascript']
+                          'application/json', 'application/javascript', 'application/x-ndjson']
     COMPRESS_LEVEL = 6
     COMPRESS_MIN_SIZE = 500
+    # Flask-Compress leaves gzip out of the streamed responses encodings: the streamed stations lists and batch data
+    # would then be sent uncompressed to the clients only accepting gzip
+    COMPRESS_ALGORITHM_STREAMING = ['zstd', 'br', 'gzip', 'deflate']
     SUPPORTED_LANGUAGES = {'en': 'English', 'fr': 'Francais'}
     BABEL_DEFAULT_LOCALE = 'en'
     BABEL_DEFAULT_TIMEZONE = 'UTC'
     SOURCES_CONFIG_FILE = 'source.ini'
     STORAGE_PATH = '/mnt/data'
     DEFAULT_NEARBY_LIMIT = 5
+    # Number of observations returned by ?scope=latest, when not given by the n parameter
+    DEFAULT_LATEST_LIMIT = 1
+    # In-process cache of the parsed stations lists: max number of cached lists, and max cumulated size of their files
+    CATALOG_CACHE_MAX_ENTRIES = 16
+    CATALOG_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    # Compression of the pre-serialized stations lists responses
+    PRECOMPRESS_GZIP_LEVEL = 9
+    PRECOMPRESS_BROTLI_QUALITY = 9
+    # Thumbnails rendered on demand: disk cache folder (defaults to the cache/thumbnails folder of STORAGE_PATH), max
+    # size of the disk cache and of the in-memory cache, max width and height (pixels)
+    THUMBNAIL_CACHE_PATH = None
+    THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    THUMBNAIL_MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    THUMBNAIL_MAX_SIZE = 2000
+    # Stream the merged stations list feature by feature instead of serving it pre-serialized (lower memory use, but
+    # serialized and compressed on every request)
+    STREAM_STATIONS_LIST = False
+    # Batch station data endpoint: max number of stations per request, and number of series loaded in parallel
+    BATCH_DATA_MAX_STATIONS = 100
+    BATCH_DATA_WORKERS = 4
+    # Metrics: folder where every process writes its metrics, summed by the /metrics endpoint (defaults to a folder of
+    # the system's temporary directory), and min delay between two writes of a process' metrics, in seconds
+    METRICS_PATH = None
+    METRICS_FLUSH_INTERVAL = 5
+    # Min delay between two reads of the data generation published by prepare_stations.py, in seconds: the stations
+    # lists changes are seen within this delay
+    GENERATION_CHECK_INTERVAL = 5
 
 
 class DevelopmentConfig(BaseConfig):
@@ -55,6 +85,19 @@ ENVIRONMENT_OVERRIDES = [
     "SOURCES_CONFIG_FILE",
     "STORAGE_PATH",
     "DEFAULT_NEARBY_LIMIT",
+    "DEFAULT_LATEST_LIMIT",
+    "CATALOG_CACHE_MAX_ENTRIES",
+    "CATALOG_CACHE_MAX_BYTES",
+    "BATCH_DATA_MAX_STATIONS",
+    "BATCH_DATA_WORKERS",
+    "STREAM_STATIONS_LIST",
+    "THUMBNAIL_CACHE_PATH",
+    "THUMBNAIL_CACHE_MAX_BYTES",
+    "THUMBNAIL_MEMORY_CACHE_MAX_BYTES",
+    "THUMBNAIL_MAX_SIZE",
+    "METRICS_PATH",
+    "METRICS_FLUSH_INTERVAL",
+    "GENERATION_CHECK_INTERVAL",
 ]
 
 def configure_app(app):
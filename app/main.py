@@ -1,6 +1,9 @@
-from app import app
+from app import app, io_helper
 
 import views
 
+# map the merged stations list and build its spatial index before the workers are forked, so that they share them
+io_helper.merged_catalog()
+
 if __name__ == '__main__':
     app.run()
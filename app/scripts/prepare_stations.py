@@ -5,40 +5,88 @@ Reads the source configuration from app configuration,
 retrieves the stations list for web resources (only),
 downloads the stations data locally for web resources (only),
 generates the stations list file for every source (so that the list is homogeneous from one source to another),
-produces the png thumbnails.
+writes the stations data as binary series files, read by the API instead of the TXT files, along with their monthly
+and yearly aggregates,
+computes the stations statistics (min, max, mean, trend, monthly climatology, latest observation and its anomaly),
+produces the thumbnails (matplotlib graphs, or png / svg sparklines),
+writes the merged stations list of all sources (optionally deduplicated), as JSON and as the binary catalog
+memory-mapped by the API processes (see utils/shared_catalog.py).
+The outputs read by the API are written atomically, and only when their content changes. When one of them changed, a
+new data generation is published (generation.json, in the storage root) as soon as the stations lists, statistics and
+merged stations list are written, the thumbnails being rendered afterwards: the API processes read it periodically and
+reload their cached stations lists when it changes.
+With --daemon, the script keeps running and refreshes every source on its own interval (refresh_interval key of the
+source in sources.ini, in seconds).
 All data is stored in files. The paths patterns are defined in utils/io_utils.py (class IoHelper). The root path can be
 defined in the app's configuration
 
-For now, all data is retrieved and re-generated at every run.
-TODO: optimize the resource consumption.
-- Only process data that have new values
-- only get the new values for hydroweb resources available through api
+Runs are incremental: a manifest, stored for every source, records for each station the hash of its data file, the
+ETag/Last-Modified headers it was downloaded with, its last observation date and the outputs generated for it. Stations
+whose data did not change since the previous run are neither downloaded again nor re-processed. Use -f/--force to
+re-process everything.
+TODO: only get the new values for hydroweb resources available through api
 '''
 
 import logging
 import argparse
+import cProfile
 import glob
+import hashlib
+import importlib
 import json
-import numpy
 import re
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+import threading
 import time
-from os import environ, path, makedirs, remove, getenv
-from matplotlib import pyplot, dates as mdates
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from os import environ, path, makedirs, remove, getenv, stat, utime, cpu_count
+from urllib.parse import urlsplit
 
 from app import app
 
 # local to the module
-from utils import io_utils, parsing
+from utils import io_utils, parsing, series as series_utils, shared_catalog
 
 logger = logging.getLogger()
 io_helper = app.io_helper
 CLEAN_DEPRECATED_STATIONS = False
+DEDUPLICATE_STATIONS = False
+FORCE = False
+MANIFEST_VERSION = 1
+# Per-station output files (besides the station's feature in the stations list): output name -> io_helper path key
+STATION_OUTPUTS = {
+    'series': 'stations.series',
+    'thumbnail': 'stations.png',
+    'thumbnail_svg': 'stations.svg',
+}
+# Thumbnail engines: name -> (rendering module, output path key, output url key). The rendering module provides
+# render_station, and optionally init_worker (rendering worker initializer). It is imported only when thumbnails are
+# rendered: matplotlib alone takes longer to import than the rest of the script.
+# 'matplotlib' draws graphs with axes, 'png' and 'svg' draw lightweight sparklines (see utils/sparklines.py)
+THUMBNAIL_ENGINES = {
+    'matplotlib': ('utils.thumbnails', 'stations.png', 'stations.png.url'),
+    'png': ('utils.sparklines', 'stations.png', 'stations.png.url'),
+    'svg': ('utils.sparklines', 'stations.svg', 'stations.svg.url'),
+}
 
 REQUESTS_MAX_RETRIES=int(environ.get('REQUESTS_MAX_RETRIES','5'))
+# Number of concurrent station downloads
+DOWNLOAD_WORKERS=int(environ.get('DOWNLOAD_WORKERS','4'))
+# Max number of requests per second sent to a same host (0: no limit)
+REQUESTS_RATE_LIMIT=float(environ.get('REQUESTS_RATE_LIMIT','0'))
+# Number of thumbnail rendering processes (1: render in the main process)
+THUMBNAIL_WORKERS=int(environ.get('THUMBNAIL_WORKERS', cpu_count() or 1))
+# Thumbnail engine (see THUMBNAIL_ENGINES)
+THUMBNAIL_ENGINE=environ.get('THUMBNAIL_ENGINE', 'matplotlib')
+# Refresh interval of the sources in daemon mode, in seconds, unless given by their refresh_interval key
+REFRESH_INTERVAL=int(environ.get('REFRESH_INTERVAL', '3600'))
+# Number of stations listed in the run report, slowest first
+REPORT_SLOWEST_STATIONS=int(environ.get('REPORT_SLOWEST_STATIONS', '10'))
 # Configure requests object
 retry_strategy = Retry(
     total=REQUESTS_MAX_RETRIES,
@@ -46,12 +94,164 @@ retry_strategy = Retry(
     status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["HEAD", "GET", "OPTIONS"]
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
-http = requests.Session()
-http.mount("https://", adapter)
-http.mount("http://", adapter)
+
+
+def _new_session():
+    """
+    Create a requests session, using the retry strategy to handle timeouts and server failures (including 429)
+    """
+    adapter = HTTPAdapter(max_retries=retry_strategy)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+http = _new_session()
+# requests sessions are not guaranteed to be thread-safe: the download workers use one session per thread
+_thread_local = threading.local()
+
+
+def _thread_session():
+    if not hasattr(_thread_local, 'http'):
+        _thread_local.http = _new_session()
+    return _thread_local.http
+
+
+class RateLimiter():
+    """
+    Spaces out the requests sent to a same host, so that at most `rate` requests per second are sent to it.
+    Shared between the download threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Block until a request can be sent to the url's host
+        :param url:
+        :return:
+        """
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RunReport():
+    """
+    Timings and counters of a run: the wall time of every stage, and the time spent on every station, by stage. With
+    concurrent downloads or rendering processes, the stations time of a stage exceeds its wall time.
+    Stages: list_fetch, download, header_parse (txt2geojson), catalog_write (stations lists), series, statistics,
+    thumbnails, merged_catalog
+    """
+
+    def __init__(self):
+        # stage -> {'seconds', 'runs', 'stations', 'station_seconds'}
+        self.stages = {}
+        # (source id, station id) -> {stage: seconds}
+        self.stations = {}
+        self.bytes_downloaded = 0
+        self.files_downloaded = 0
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {'seconds': 0.0, 'runs': 0, 'stations': 0, 'station_seconds': 0.0})
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage
+        :param name: stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage = self._stage(name)
+                stage['seconds'] += elapsed
+                stage['runs'] += 1
+
+    def station(self, name, source_id, station_id, seconds):
+        """
+        Record the time spent on a station. Thread-safe
+        :param name: stage name
+        :param source_id:
+        :param station_id:
+        :param seconds:
+        """
+        with self._lock:
+            stage = self._stage(name)
+            stage['stations'] += 1
+            stage['station_seconds'] += seconds
+            timings = self.stations.setdefault((source_id, station_id), {})
+            timings[name] = timings.get(name, 0.0) + seconds
+
+    def downloaded(self, size):
+        """
+        Record a downloaded file. Thread-safe
+        :param size: file size, in bytes
+        """
+        with self._lock:
+            self.bytes_downloaded += size
+            self.files_downloaded += 1
+
+    def slowest(self, n):
+        """
+        :return: the n stations on which the most time was spent, as (source id, station id, {stage: seconds}) tuples
+        """
+        with self._lock:
+            ranked = sorted(self.stations.items(), key=lambda item: sum(item[1].values()), reverse=True)[:n]
+        return [(source_id, station_id, timings) for (source_id, station_id), timings in ranked]
+
+    def as_dict(self, slowest=REPORT_SLOWEST_STATIONS):
+        """
+        :return: JSON-serializable report
+        """
+        return {
+            'seconds': time.perf_counter() - self._start,
+            'bytes_downloaded': self.bytes_downloaded,
+            'files_downloaded': self.files_downloaded,
+            'stages': self.stages,
+            'slowest_stations': [{'source': source_id, 'station': station_id, 'seconds': sum(timings.values()),
+                                  'stages': timings}
+                                 for source_id, station_id, timings in self.slowest(slowest)],
+        }
+
+    def log(self, slowest=REPORT_SLOWEST_STATIONS):
+        """
+        Log the summary of the run
+        """
+        report = self.as_dict(slowest)
+        logger.info('run: {:.1f}s, {} files downloaded ({:.1f} MiB)'.format(
+            report['seconds'], report['files_downloaded'], report['bytes_downloaded'] / 1024 / 1024))
+        for name, stage in sorted(report['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+            logger.info('  {:<15} {:8.2f}s wall, {} station(s), {:.2f}s on stations'.format(
+                name, stage['seconds'], stage['stations'], stage['station_seconds']))
+        if report['slowest_stations']:
+            logger.info('slowest stations:')
+        for station in report['slowest_stations']:
+            logger.info('  {}/{}: {:.3f}s ({})'.format(
+                station['source'], station['station'], station['seconds'],
+                ', '.join('{} {:.3f}s'.format(k, v) for k, v in station['stages'].items())))
+
+
+report = RunReport()
+
 
 def main():
+    global DOWNLOAD_WORKERS, REQUESTS_RATE_LIMIT, THUMBNAIL_WORKERS, THUMBNAIL_ENGINE
     # Input arguments
     parser = argparse.ArgumentParser(description='''
     Reads the source configuration, scans the stations and produces:
@@ -66,8 +266,36 @@ def main():
                         action='store_true')
     parser.add_argument('--logfile',
                         help='logfile path. Default: prints logs to the console')
-    parser.add_argument('-f', '--force', help='DEPRECATED',
+    parser.add_argument('-d', '--deduplicate',
+                        help='remove, from the merged stations list, the stations located at the same coordinates as '
+                             'a previous one',
+                        action='store_true')
+    parser.add_argument('-w', '--download_workers', type=int, default=DOWNLOAD_WORKERS,
+                        help='[http(s) sources only] number of concurrent station downloads. Default: {}'.format(
+                            DOWNLOAD_WORKERS))
+    parser.add_argument('--rate_limit', type=float, default=REQUESTS_RATE_LIMIT,
+                        help='[http(s) sources only] max number of requests per second sent to a same host. '
+                             '0 for no limit. Default: {}'.format(REQUESTS_RATE_LIMIT))
+    parser.add_argument('-t', '--thumbnail_workers', type=int, default=THUMBNAIL_WORKERS,
+                        help='number of thumbnail rendering processes. 1 renders in the main process. Default: {}'.format(
+                            THUMBNAIL_WORKERS))
+    parser.add_argument('-e', '--thumbnail_engine', choices=sorted(THUMBNAIL_ENGINES), default=THUMBNAIL_ENGINE,
+                        help='thumbnails rendering: matplotlib graphs, or png / svg sparklines (much faster, smaller '
+                             'files). Use -f to re-render the existing png thumbnails with another engine. '
+                             'Default: {}'.format(THUMBNAIL_ENGINE))
+    parser.add_argument('-f', '--force', help='re-process all stations, even the ones that did not change since the '
+                                              'previous run (first refresh only, in daemon mode)',
+                        action='store_true')
+    parser.add_argument('--daemon', help='keep running, refreshing every source on its own interval: its '
+                                         'refresh_interval key in sources.ini (seconds), else {}s'.format(
+                                             REFRESH_INTERVAL),
                         action='store_true')
+    parser.add_argument('--report',
+                        help='write the run report (time spent by stage, slowest stations, bytes downloaded) to this '
+                             'JSON file, after every refresh in daemon mode. The summary is logged in any case')
+    parser.add_argument('--profile',
+                        help='profile the run with cProfile and write the statistics to this file (pstats format). '
+                             'Only the main thread is profiled: the downloads and rendering processes are not')
     args = parser.parse_args()
 
     # INITIALIZE LOGGER
@@ -87,10 +315,125 @@ def main():
     if args.clean_deprecated_stations:
         global CLEAN_DEPRECATED_STATIONS
         CLEAN_DEPRECATED_STATIONS = True
+    if args.force:
+        global FORCE
+        FORCE = True
+    if args.deduplicate:
+        global DEDUPLICATE_STATIONS
+        DEDUPLICATE_STATIONS = True
+    DOWNLOAD_WORKERS = max(1, args.download_workers)
+    REQUESTS_RATE_LIMIT = args.rate_limit
+    THUMBNAIL_WORKERS = max(1, args.thumbnail_workers)
+    THUMBNAIL_ENGINE = args.thumbnail_engine
     srcs = app.sources
 
-    for src_name, src in srcs.items():
-        prepare_stations_for_source(src)
+    if args.daemon:
+        run_daemon(srcs, args.report, args.profile)
+    else:
+        refresh(srcs, list(srcs), args.report, args.profile)
+
+
+def refresh(srcs, src_ids, report_file=None, profile_file=None):
+    """
+    Prepare some sources, then the merged stations list, publish a new data generation if the outputs read by the
+    API changed, and render the sources' thumbnails. The generation is published before the thumbnails are rendered,
+    so that the API processes don't serve different stations lists during the rendering
+    :param srcs: sources definitions
+    :param src_ids: ids of the sources to prepare
+    :param report_file: run report file (JSON)
+    :param profile_file: cProfile statistics file
+    :return: True if a new generation was published
+    """
+    global report
+    report = RunReport()
+    before = _outputs_signature(srcs)
+
+    profiler = cProfile.Profile() if profile_file else None
+    if profiler:
+        profiler.enable()
+    prepared = {src_id: prepare_stations_for_source(srcs[src_id]) for src_id in src_ids}
+
+    with report.stage('merged_catalog'):
+        _generate_merged_catalog(srcs)
+
+    published = _outputs_signature(srcs) != before or not path.exists(io_helper.paths['generation'])
+    if published:
+        logger.info('published data generation {}'.format(_publish_generation()))
+
+    for src_id, (files, changed, features, manifest) in prepared.items():
+        render_thumbnails_for_source(srcs[src_id], files, changed, features, manifest)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        logger.debug('profile written to {}'.format(profile_file))
+
+    report.log()
+    if report_file:
+        with io_utils.atomic_open(report_file) as outfile:
+            json.dump(report.as_dict(), outfile, indent=2)
+    return published
+
+
+def run_daemon(srcs, report_file=None, profile_file=None):
+    """
+    Refresh every source on its own interval, until interrupted. A failed refresh is logged and tried again on the
+    source's next turn
+    :param srcs: sources definitions
+    :param report_file: run report file (JSON), written after every refresh
+    :param profile_file: cProfile statistics file, written after every refresh
+    :return:
+    """
+    global FORCE
+    intervals = {src_id: float(src.get('refresh_interval') or REFRESH_INTERVAL) for src_id, src in srcs.items()}
+    next_runs = {src_id: time.monotonic() for src_id in srcs}
+    logger.info('daemon mode, refresh intervals: {}'.format(
+        ', '.join('{} {:.0f}s'.format(src_id, interval) for src_id, interval in intervals.items())))
+    while True:
+        now = time.monotonic()
+        due = [src_id for src_id, next_run in next_runs.items() if next_run <= now]
+        if due:
+            try:
+                refresh(srcs, due, report_file, profile_file)
+            except Exception:
+                logger.exception('failed to refresh {}'.format(', '.join(due)))
+            FORCE = False
+            for src_id in due:
+                next_runs[src_id] = now + intervals[src_id]
+        time.sleep(max(0, min(next_runs.values()) - time.monotonic()))
+
+
+def _outputs_signature(srcs):
+    """
+    :return: the signatures (modification time, size) of the files cached by the API: stations lists, statistics and
+    merged catalog
+    """
+    files = [io_helper.paths[key].format(source_id=src['id']) for src in srcs.values()
+             for key in ('stations.list', 'stations.statistics')]
+    files += [io_helper.paths['merged.list'], io_helper.paths['merged.catalog']]
+    signatures = []
+    for file in files:
+        try:
+            st = stat(file)
+            signatures.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signatures.append(None)
+    return signatures
+
+
+def _publish_generation():
+    """
+    Increment the data generation watched by the API (see IoHelper.generation)
+    :return: the new generation number
+    """
+    filename = io_helper.paths['generation']
+    try:
+        with open(filename) as generation_file:
+            generation = int(json.load(generation_file)['generation'])
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        generation = 0
+    with io_utils.atomic_open(filename) as outfile:
+        json.dump({'generation': generation + 1, 'updated': datetime.now(timezone.utc).isoformat()}, outfile)
+    return generation + 1
 
 
 class ShouldPauseDownloadException(Exception):
@@ -103,9 +446,11 @@ def prepare_stations_for_source(src):
     retrieves the stations list for this source,
     downloads the stations data locally for web resources,
     re-creates the stations list (for consistency between local and remote source)
-    produces the png thumbnails.
+    writes the binary series files,
+    computes the stations statistics.
+    The thumbnails are produced by render_thumbnails_for_source.
     :param src:
-    :return:
+    :return: (data files, ids of the stations to process, features, manifest) tuple, for render_thumbnails_for_source
     """
 
     # make sure the folders exist
@@ -113,34 +458,209 @@ def prepare_stations_for_source(src):
         if k.endswith('.folder'):
             makedirs(v.format(source_id = src['id']), exist_ok=True)
 
-    # remove stations that are on the disk but not any more listed on the http source: simplest way is to remove them
-    # all before downloading them again
-    if CLEAN_DEPRECATED_STATIONS:
-        on_disk = glob.glob(io_helper.paths['stations.data'].format(source_id=src['id'], station_id='*'))
-        for station in on_disk:
-            remove(station) # delete file
+    manifest = _load_manifest(src)
 
     # Retrieve the data.
     if src['list_uri'].startswith("http"):
-        r = http.get(src['list_uri'])
-        _retrieve_stations_data(src, r.json())
+        with report.stage('list_fetch'):
+            r = http.get(src['list_uri'])
+            stations_list = r.json()
+        # remove stations that are on the disk but not any more listed on the http source
+        if CLEAN_DEPRECATED_STATIONS:
+            _clean_deprecated_stations(src, stations_list, manifest)
+        with report.stage('download'):
+            _retrieve_stations_data(src, stations_list, manifest)
 
     # Get the files list
     # files = []
     files = glob.glob(io_helper.paths['stations.data'].format(source_id=src['id'], station_id='*'))
+    changed = _changed_stations(files, manifest)
+    logger.info('{}: {} stations, {} to process'.format(src['id'], len(files), len(changed)))
 
     # create the stations list in geojson format,
-    _generate_stations_list(src, files)
+    features = _generate_stations_list(src, files, changed)
+
+    # write the data as binary series, faster to load for the API
+    with report.stage('series'):
+        _generate_series(src, files, changed)
 
+    # compute the stations statistics (min, max, trend, climatology, latest observation...)
+    with report.stage('statistics'):
+        _generate_statistics(src, files, changed)
+    return files, changed, features, manifest
+
+
+def render_thumbnails_for_source(src, files, changed, features, manifest):
+    """
+    Produces the thumbnails of a source prepared by prepare_stations_for_source, and saves its manifest
+    :param src:
+    :param files: data files
+    :param changed: ids of the stations to process
+    :param features: the source's stations features
+    :param manifest: the source's manifest
+    :return:
+    """
     # generate graph thumbnails
-    _generate_thumbnails(src, files)
+    with report.stage('thumbnails'):
+        _generate_thumbnails(src, files, changed)
+
+    # record the outputs available for each station
+    last_observations = {f['properties']['productIdentifier']: str(f['properties']['completionDate'])
+                         for f in features}
+    for station_id, entry in manifest['stations'].items():
+        entry['outputs'] = [output for output, key in STATION_OUTPUTS.items()
+                            if path.exists(io_helper.paths[key].format(source_id=src['id'], station_id=station_id))]
+        if station_id in last_observations:
+            entry['last_observation'] = last_observations[station_id]
+            entry['outputs'].insert(0, 'feature')
+    _save_manifest(src, manifest)
+
+
+def _generate_merged_catalog(srcs):
+    """
+    Write the merged stations list of all sources, served by the API on /api/v1/stations: as JSON, and as the binary
+    catalog (features, source ids, coordinates and productIdentifier index) the API processes memory-map.
+    If DEDUPLICATE_STATIONS is set, the stations located at the same coordinates as a previous one are left out
+    :param srcs: sources definitions
+    :return:
+    """
+    features, feature_sources = [], []
+    seen = set()
+    for src_name, src in srcs.items():
+        try:
+            with open(io_helper.paths['stations.list'].format(source_id=src['id'])) as list_file:
+                source_features = json.load(list_file)['features']
+        except FileNotFoundError:
+            continue
+        for f in source_features:
+            if DEDUPLICATE_STATIONS:
+                coordinates = tuple(f['geometry']['coordinates'])
+                if coordinates in seen:
+                    logger.debug('dropping duplicate station {}'.format(f['properties']['productIdentifier']))
+                    continue
+                seen.add(coordinates)
+            features.append(f)
+            feature_sources.append(src['id'])
+
+    stations_list = {
+        'type': 'FeatureCollection',
+        'properties': {},
+        'totalResults': len(features),
+        'features': features
+    }
+
+    io_utils.write_if_changed(io_helper.paths['merged.list'],
+                              json.dumps(stations_list, indent=2, sort_keys=False, default=str).encode())
+    catalog = BytesIO()
+    shared_catalog.write_catalog(catalog, features, feature_sources)
+    io_utils.write_if_changed(io_helper.paths['merged.catalog'], catalog.getvalue())
+    logger.info('merged stations list: {} stations'.format(len(features)))
 
 
-def _retrieve_stations_data(src, stations_list):
+def _station_id(file):
+    return path.splitext(path.basename(file))[0]
+
+
+def _load_manifest(src):
+    """
+    Load the manifest of the previous run for this source
+    :param src:
+    :return: manifest dict. 'stations' maps station ids to dicts with sha256, etag, last_modified, last_observation and
+    outputs keys
+    """
+    filename = io_helper.paths['stations.manifest'].format(source_id=src['id'])
+    try:
+        with open(filename) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (FileNotFoundError, ValueError) as e:
+        logger.debug('no valid manifest for {}: {}'.format(src['id'], e))
+    return {'version': MANIFEST_VERSION, 'stations': {}}
+
+
+def _save_manifest(src, manifest):
+    filename = io_helper.paths['stations.manifest'].format(source_id=src['id'])
+    with io_utils.atomic_open(filename) as outfile:
+        json.dump(manifest, outfile, indent=2, sort_keys=True)
+
+
+def _changed_stations(files_list, manifest):
+    """
+    Compare the data files with the manifest
+    The files whose size and modification time match the manifest are not read. The others are hashed and considered
+    changed only if their hash differs.
+    :param files_list: data files on disk
+    :param manifest: updated in place (hashes, and entries of the stations that are not on disk anymore are removed)
+    :return: set of the ids of new or changed stations. All stations if FORCE is set
+    """
+    changed = set()
+    stations = manifest['stations']
+    on_disk = set()
+    for file in files_list:
+        station_id = _station_id(file)
+        on_disk.add(station_id)
+        st = stat(file)
+        signature = [st.st_mtime_ns, st.st_size]
+        entry = stations.setdefault(station_id, {})
+        if entry.get('signature') != signature:
+            sha256 = _file_sha256(file)
+            if entry.get('sha256') != sha256:
+                changed.add(station_id)
+            entry['sha256'] = sha256
+            entry['signature'] = signature
+        if FORCE:
+            changed.add(station_id)
+    for station_id in set(stations) - on_disk:
+        del stations[station_id]
+    return changed
+
+
+def _file_sha256(file):
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _clean_deprecated_stations(src, stations_list, manifest):
+    """
+    Remove the files of the stations that are on the disk but not any more listed on the http source
+    :param src:
+    :param stations_list: stations list retrieved from the source
+    :param manifest: updated in place
+    :return:
+    """
+    listed = set(f['properties']['productIdentifier'] for f in stations_list['features'])
+    on_disk = glob.glob(io_helper.paths['stations.data'].format(source_id=src['id'], station_id='*'))
+    for file in on_disk:
+        station_id = _station_id(file)
+        if station_id in listed:
+            continue
+        logger.info('removing deprecated station {}'.format(station_id))
+        outputs = [io_helper.paths[key].format(source_id=src['id'], station_id=station_id)
+                   for key in STATION_OUTPUTS.values()]
+        outputs += [io_helper.paths['stations.series.level'].format(source_id=src['id'], station_id=station_id,
+                                                                    level=level)
+                    for level in series_utils.AGGREGATION_LEVELS]
+        for output in outputs:
+            try:
+                remove(output)
+            except FileNotFoundError:
+                pass
+        remove(file)
+        manifest['stations'].pop(station_id, None)
+
+
+def _retrieve_stations_data(src, stations_list, manifest):
     """
     Downloads the data files for each station of this data source and stores it locally for further use
+    The download is conditional, using the ETag/Last-Modified headers recorded in the manifest, and the file is
+    rewritten only if its content changed
     :param src:
     :param stations_list:
+    :param manifest: updated in place
     :return: lists tuple unchanged_files_list, new_files_list
     """
     details_uri = src['details_uri']
@@ -156,29 +676,126 @@ def _retrieve_stations_data(src, stations_list):
             pass
 
 
-    for f in stations_list['features']:
-        url = details_uri.format(id=f['properties']['productIdentifier'])
-
-        dest_file = io_helper.paths['stations.data'].format(source_id=src['id'],
-                                                           station_id = f['properties']['productIdentifier'])
-
-        # Download files using requests.Retry to handle timeouts and server failures
+    # Download files concurrently, the results being collected (and the manifest updated) in the main thread
+    rate_limiter = RateLimiter(REQUESTS_RATE_LIMIT)
+    unchanged_files_list, new_files_list = [], []
+    executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    try:
+        futures = {}
+        for f in stations_list['features']:
+            station_id = f['properties']['productIdentifier']
+            url = details_uri.format(id=station_id)
+            dest_file = io_helper.paths['stations.data'].format(source_id=src['id'],
+                                                               station_id = station_id)
+            entry = dict(manifest['stations'].get(station_id, {}))
+            futures[executor.submit(_timed_download, src['id'], station_id, url, dest_file, entry,
+                                    rate_limiter)] = station_id
+
+        for future in as_completed(futures):
+            station_id = futures[future]
+            status, dest_file, headers = future.result()
+            if status is None:
+                continue
+            if headers is not None:
+                entry = manifest['stations'].setdefault(station_id, {})
+                entry['etag'] = headers.get('ETag')
+                entry['last_modified'] = headers.get('Last-Modified')
+            if status:
+                new_files_list.append(dest_file)
+            else:
+                unchanged_files_list.append(dest_file)
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    return unchanged_files_list, new_files_list
+
+
+def _timed_download(source_id, station_id, *args):
+    """
+    Run _download_station, recording its duration in the run report
+    """
+    start = time.perf_counter()
+    try:
+        return _download_station(*args)
+    finally:
+        report.station('download', source_id, station_id, time.perf_counter() - start)
 
-        response = http.get(url)
-        response.raise_for_status()
-        if response.status_code == 200:
-            # Write data to file
-            open(dest_file, 'wb').write(response.content)
-        else:
-            logger.warning("Error while retrieving {}".format(url))
 
+def _download_station(url, dest_file, entry, rate_limiter):
+    """
+    Download the data file of a station. Runs in a download thread
+    The download is conditional, using the ETag/Last-Modified headers of the station's manifest entry. The file is
+    written atomically, so that the API never reads a partially written file
+    :param url:
+    :param dest_file:
+    :param entry: the station's manifest entry (read-only)
+    :param rate_limiter: RateLimiter shared between the download threads
+    :return: (status, dest_file, response headers) tuple. status is True if the file was (re)written, False if it is
+    unchanged, None on error
+    """
+    headers = {}
+    if not FORCE and path.exists(dest_file):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    # Download files using requests.Retry to handle timeouts and server failures
+    rate_limiter.wait(url)
+    response = _thread_session().get(url, headers=headers)
+    response.raise_for_status()
+    if response.status_code == 304:
+        return False, dest_file, None
+    elif response.status_code == 200:
+        report.downloaded(len(response.content))
+        sha256 = hashlib.sha256(response.content).hexdigest()
+        if sha256 == entry.get('sha256') and path.exists(dest_file):
+            return False, dest_file, response.headers
+        # Write data to file
+        with io_utils.atomic_open(dest_file, 'wb') as outfile:
+            outfile.write(response.content)
+        logger.debug("downloaded {}".format(dest_file))
+        return True, dest_file, response.headers
+    else:
+        logger.warning("Error while retrieving {}".format(url))
+        return None, dest_file, None
+
+
+def _generate_stations_list(src, files_list, changed=None):
+    """
+    Generate the stations list file for this source
+    :param src:
+    :param files_list: data files
+    :param changed: ids of the stations to process. The features of the other stations are taken from the previous
+    stations list when available. None to process all stations
+    :return: the features
+    """
+    filename = io_helper.paths['stations.list'].format(source_id=src['id'])
+    previous = {}
+    if changed is not None:
+        try:
+            with open(filename) as previous_file:
+                previous = {f['properties']['productIdentifier']: f for f in json.load(previous_file)['features']}
+        except (FileNotFoundError, ValueError, KeyError) as e:
+            logger.debug('previous stations list not available for {}: {}'.format(src['id'], e))
 
-def _generate_stations_list(src, files_list):
     features = []
     for file in files_list:
+        station_id = _station_id(file)
+        url_key = THUMBNAIL_ENGINES[THUMBNAIL_ENGINE][2]
+        if changed is not None and station_id not in changed and station_id in previous:
+            feature = previous[station_id]
+            # the thumbnail engine may have changed
+            feature['properties']['thumbnail'] = io_helper.paths[url_key].format(source_id=src['id'],
+                                                                                 station_id=station_id)
+            features.append(feature)
+            continue
         try:
+            start = time.perf_counter()
             line_as_feature = parsing.txt2geojson(file)
-            line_as_feature['properties']['thumbnail'] = io_helper.paths['stations.png.url'].format(source_id = src['id'],
+            report.station('header_parse', src['id'], station_id, time.perf_counter() - start)
+            line_as_feature['properties']['thumbnail'] = io_helper.paths[url_key].format(source_id = src['id'],
                                                     station_id = line_as_feature['properties']['productIdentifier'])
             line_as_feature['properties']['collection'] = src.get('name')
             features.append(line_as_feature)
@@ -192,40 +809,152 @@ def _generate_stations_list(src, files_list):
         'features': features
     }
 
-    filename = io_helper.paths['stations.list'].format(source_id=src['id'])
-    with open(filename, 'w') as outfile:
-        json.dump(stations_list, outfile, indent=2, sort_keys=False, default=str)
+    with report.stage('catalog_write'):
+        io_utils.write_if_changed(filename, json.dumps(stations_list, indent=2, sort_keys=False, default=str).encode())
+    return features
+
+
+def _generate_series(src, files_list, changed=None):
+    """
+    Write the binary series files: the raw series, and its pyramid of aggregated levels (see
+    series.AGGREGATION_LEVELS), from which the API serves long time spans
+    :param src:
+    :param files_list: data files
+    :param changed: ids of the stations to process. The other ones are processed only if some of their files are
+    missing. None to process all stations
+    :return:
+    """
+    for file in files_list:
+        station_id = _station_id(file)
+        filename = io_helper.paths['stations.series'].format(source_id=src['id'], station_id=station_id)
+        levels = {level: io_helper.paths['stations.series.level'].format(source_id=src['id'], station_id=station_id,
+                                                                         level=level)
+                  for level in series_utils.AGGREGATION_LEVELS}
+        outputs = [filename] + list(levels.values())
+        if changed is not None and station_id not in changed and all(path.exists(f) for f in outputs):
+            # same content, but the data file may have been touched (rsync, identical re-download): the API would
+            # find the series files outdated (see io_utils._is_up_to_date) and parse the TXT file on every request
+            _touch_outdated(outputs, file)
+            continue
+        try:
+            series = parsing.txt2series(file)
+        except (ValueError, IndexError) as e:
+            logger.error('failed while reading data from hydroweb TXT file {}. {}'.format(file, e))
+            continue
+        io_utils.write_series(filename, series)
+        for level, level_file in levels.items():
+            io_utils.write_series(level_file, series_utils.aggregate(series, level))
+        logger.debug("wrote series for station {}".format(station_id))
+
+
+def _touch_outdated(derived_files, original):
+    """
+    Set the modification time of the derived files older than the original file to the original's one
+    :param derived_files: files derived from the original one
+    :param original: original file path
+    :return:
+    """
+    original_mtime = stat(original).st_mtime_ns
+    for derived in derived_files:
+        st = stat(derived)
+        if st.st_mtime_ns < original_mtime:
+            utime(derived, ns=(st.st_atime_ns, original_mtime))
 
 
-def _generate_thumbnails(src, files_list):
-    pyplot.rcParams['font.size'] = 6.0
-    pyplot.rcParams['figure.frameon'] = False
-    pyplot.rcParams['figure.figsize'] = [3, 2]
+def _generate_statistics(src, files_list, changed=None):
+    """
+    Generate the statistics file of this source: station id -> statistics (see series.statistics)
+    :param src:
+    :param files_list: data files
+    :param changed: ids of the stations to process. The statistics of the other stations are taken from the previous
+    statistics file when available. None to process all stations
+    :return:
+    """
+    filename = io_helper.paths['stations.statistics'].format(source_id=src['id'])
+    previous = {}
+    if changed is not None:
+        try:
+            with open(filename) as previous_file:
+                previous = json.load(previous_file)
+        except (FileNotFoundError, ValueError) as e:
+            logger.debug('previous statistics not available for {}: {}'.format(src['id'], e))
+
+    statistics = {}
     for file in files_list:
+        station_id = _station_id(file)
+        if changed is not None and station_id not in changed and station_id in previous:
+            statistics[station_id] = previous[station_id]
+            continue
+        series_file = io_helper.paths['stations.series'].format(source_id=src['id'], station_id=station_id)
         try:
-            data = parsing.txt2data_vectors(file)
-            # parse dates as dates
-            x = [datetime.strptime(ii, "%Y-%m-%d %H:%M") for ii in data['dates']]
-            a_x = numpy.asarray(x)
-            a_y = numpy.asarray(data['h'], numpy.float32)
-            #ax.xaxis.set_minor_locator(mdates.MonthLocator())
-            fig, ax = pyplot.subplots()
-            ax.xaxis.set_major_locator(mdates.YearLocator())
-            ax.spines['top'].set_visible(False)
-            ax.spines['right'].set_visible(False)
-            ax.spines['bottom'].set_visible(True)
-            ax.spines['left'].set_visible(True)
-            ax.plot_date(a_x, a_y, fmt='b-', xdate=True, ydate=False, linewidth=0.5)
-
-            filename = '{}.png'.format(path.splitext(path.basename(file))[0])
-            filepath = path.join(io_helper.paths['png.folder'].format(source_id=src['id']), filename)
-            fig.savefig(filepath)
-            pyplot.close(fig)
-            #fig.show()
-            logger.debug("processed station {}".format(file))
+            statistics[station_id] = series_utils.statistics(io_utils.load_series(series_file, file))
+        except (ValueError, IndexError) as e:
+            logger.error('failed while computing statistics for hydroweb TXT file {}. {}'.format(file, e))
 
-        except parsing.HydrowebParsingError as e:
-            logger.error('failed while extracting header information for hydroweb TXT file {}. {}'.format(file, e))
+    io_utils.write_if_changed(filename, json.dumps(statistics).encode())
+
+
+def _generate_thumbnails(src, files_list, changed=None):
+    """
+    Render the graph thumbnails with THUMBNAIL_ENGINE, in a pool of THUMBNAIL_WORKERS processes (in the current
+    process if set to 1)
+    :param src:
+    :param files_list: data files
+    :param changed: ids of the stations to process. The other ones are processed only if they have no thumbnail yet.
+    None to process all stations
+    :return:
+    """
+    module_name, output_key, _ = THUMBNAIL_ENGINES[THUMBNAIL_ENGINE]
+    tasks = {}
+    for file in files_list:
+        station_id = _station_id(file)
+        filepath = io_helper.paths[output_key].format(source_id=src['id'], station_id=station_id)
+        if changed is not None and station_id not in changed and path.exists(filepath):
+            continue
+        tasks[station_id] = (file,
+                             io_helper.paths['stations.series'].format(source_id=src['id'], station_id=station_id),
+                             filepath)
+
+    if not tasks:
+        return
+    module = importlib.import_module(module_name)
+    init_worker, render_station = getattr(module, 'init_worker', None), module.render_station
+
+    start = time.perf_counter()
+    if THUMBNAIL_WORKERS > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, initializer=init_worker) as executor:
+            futures = {executor.submit(_timed_render, render_station, *task): station_id
+                       for station_id, task in tasks.items()}
+            results = ((futures[future], future.result()) for future in as_completed(futures))
+            _log_thumbnails_results(src, tasks, results)
+    else:
+        if init_worker:
+            init_worker()
+        _log_thumbnails_results(src, tasks, ((station_id, _timed_render(render_station, *task))
+                                             for station_id, task in tasks.items()))
+    elapsed = time.perf_counter() - start
+    logger.info('{}: rendered {} thumbnails in {:.1f}s ({:.1f} stations/s, {} worker(s), {} engine)'.format(
+        src['id'], len(tasks), elapsed, len(tasks) / elapsed, THUMBNAIL_WORKERS, THUMBNAIL_ENGINE))
+
+
+def _timed_render(render_station, *task):
+    """
+    Run a thumbnail rendering function. Runs in a rendering process
+    :return: (error, duration in seconds) tuple
+    """
+    start = time.perf_counter()
+    error = render_station(*task)
+    return error, time.perf_counter() - start
+
+
+def _log_thumbnails_results(src, tasks, results):
+    for station_id, (error, seconds) in results:
+        report.station('thumbnails', src['id'], station_id, seconds)
+        if error:
+            logger.error('failed while rendering thumbnail for hydroweb TXT file {}. {}'.format(tasks[station_id][0],
+                                                                                                 error))
+        else:
+            logger.debug("processed station {}".format(tasks[station_id][0]))
 
 
 if __name__ == '__main__':
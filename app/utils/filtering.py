@@ -0,0 +1,130 @@
+# encoding: utf-8
+"""Filtering of the stations lists
+
+The features of a stations list are indexed once: one value -> positions index per filterable attribute, the
+features sorted by longitude (a bounding box query is a binary search on the longitudes, then a check of the latitudes
+on the selected range only), and the observation periods as timestamp arrays.
+Queries return the positions of the matching features, in the stations list order.
+"""
+
+import numpy
+
+# filterable feature properties. Values are compared case-insensitively
+FILTER_ATTRIBUTES = ['river', 'basin', 'lake', 'status', 'type', 'country']
+
+
+def _parse_dates(values):
+    """
+    :param values: dates, as written in the stations lists (e.g. 2020-01-31 12:30:00)
+    :return: datetime64[s] array, NaT for the invalid ones
+    """
+    dates = numpy.full(len(values), numpy.datetime64('NaT'), dtype='datetime64[s]')
+    for i, value in enumerate(values):
+        try:
+            dates[i] = numpy.datetime64(str(value).strip().replace(' ', 'T'), 's')
+        except ValueError:
+            pass
+    return dates
+
+
+class FeaturesFilter():
+    """
+    Filtering index over a list of features
+    """
+
+    def __init__(self, features):
+        """
+        :param features: features sequence. It may decode its features on access (see shared_catalog.py): they are
+        read once, and only the sequence is kept
+        """
+        self.features = features
+        features = list(features)
+        coordinates = numpy.array([f['geometry']['coordinates'][:2] for f in features],
+                                  dtype=numpy.float64).reshape(-1, 2)
+        self._lon_order = numpy.argsort(coordinates[:, 0], kind='stable')
+        self._sorted_lon = coordinates[self._lon_order, 0]
+        self._lat = coordinates[:, 1]
+
+        self._attributes = {}
+        for attribute in FILTER_ATTRIBUTES:
+            positions = {}
+            for i, f in enumerate(features):
+                value = f['properties'].get(attribute)
+                if value:
+                    positions.setdefault(str(value).lower(), []).append(i)
+            self._attributes[attribute] = {k: numpy.array(v, dtype=numpy.int64) for k, v in positions.items()}
+
+        # observation periods, in epoch seconds. Unknown bounds don't restrict the period
+        start = _parse_dates([f['properties'].get('startDate') for f in features])
+        end = _parse_dates([f['properties'].get('completionDate') for f in features])
+        self._start = numpy.where(numpy.isnat(start), numpy.iinfo(numpy.int64).min, start.astype(numpy.int64))
+        self._end = numpy.where(numpy.isnat(end), numpy.iinfo(numpy.int64).max, end.astype(numpy.int64))
+
+    def __len__(self):
+        return len(self.features)
+
+    def in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        :return: positions of the features within the bounding box (bounds included). min_lon > max_lon stands for a
+        box crossing the antimeridian
+        """
+        if min_lon <= max_lon:
+            ranges = [(min_lon, max_lon)]
+        else:
+            ranges = [(min_lon, 180.0), (-180.0, max_lon)]
+        candidates = numpy.concatenate([
+            self._lon_order[numpy.searchsorted(self._sorted_lon, lo, side='left'):
+                            numpy.searchsorted(self._sorted_lon, hi, side='right')]
+            for lo, hi in ranges])
+        lat = self._lat[candidates]
+        return numpy.sort(candidates[(lat >= min_lat) & (lat <= max_lat)])
+
+    def with_attribute(self, attribute, values):
+        """
+        :param attribute: one of FILTER_ATTRIBUTES
+        :param values: accepted values
+        :return: positions of the features having one of the values
+        """
+        index = self._attributes[attribute]
+        found = [index[str(v).lower()] for v in values if str(v).lower() in index]
+        if not found:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(found))
+
+    def in_period(self, start=None, end=None):
+        """
+        :param start: epoch timestamp in seconds. None for no lower bound
+        :param end: epoch timestamp in seconds. None for no upper bound
+        :return: positions of the features whose observation period overlaps [start, end]
+        """
+        mask = numpy.ones(len(self.features), dtype=bool)
+        if start is not None:
+            mask &= self._end >= start
+        if end is not None:
+            mask &= self._start <= end
+        return numpy.flatnonzero(mask)
+
+    def query(self, bbox=None, attributes=None, start=None, end=None):
+        """
+        Combine the filters
+        :param bbox: (min_lon, min_lat, max_lon, max_lat) tuple
+        :param attributes: dict attribute -> accepted values
+        :param start: epoch timestamp in seconds
+        :param end: epoch timestamp in seconds
+        :return: positions of the matching features, in the list order
+        """
+        selections = []
+        if bbox is not None:
+            selections.append(self.in_bbox(*bbox))
+        for attribute, values in (attributes or {}).items():
+            selections.append(self.with_attribute(attribute, values))
+        if start is not None or end is not None:
+            selections.append(self.in_period(start, end))
+        if not selections:
+            return numpy.arange(len(self.features))
+        # intersect the smallest selections first
+        selections.sort(key=len)
+        positions = selections[0]
+        for selection in selections[1:]:
+            positions = numpy.intersect1d(positions, selection, assume_unique=True)
+        return positions
@@ -1,8 +1,307 @@
 # encoding: utf-8
 
 import json
+import os
+import tempfile
+import threading
+import time
+import numpy
+from collections import OrderedDict
+from contextlib import contextmanager
 from os import path
-from utils import parsing
+from utils import filtering, parsing, series as series_utils, spatial
+from utils.shared_catalog import SharedCatalog
+from utils.metrics import metrics
+
+
+class CatalogCache():
+    """
+    In-process cache for the parsed stations lists (stations.json files).
+    An entry is reloaded only when the file's signature (mtime, size) changes on disk, e.g. after prepare_stations.py
+    rewrote it. The cache is bounded, both in number of entries and in cumulated size of the cached files (used as a
+    proxy of the memory footprint), the least recently used entries being evicted first.
+    When a generation is given (see IoHelper.generation), an entry loaded in this generation is served without checking
+    its file again.
+    The cached objects are shared: callers must not modify them.
+    """
+
+    def __init__(self, max_entries=16, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # uri -> (signature, size, data, generation)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def get(self, uri, loader=json.load, mode='r', generation=None):
+        """
+        Get the parsed content of the file at uri, loading it if not cached or if the file changed since it was cached
+        :param uri: file path
+        :param loader: function parsing the opened file
+        :param mode: file opening mode
+        :param generation: current data generation. None to check the file on every call
+        :return: the parsed content
+        """
+        if generation is not None:
+            with self._lock:
+                entry = self._entries.get(uri)
+                if entry and entry[3] == generation:
+                    self._entries.move_to_end(uri)
+                    self.hits += 1
+                    return entry[2]
+        st = os.stat(uri)
+        signature = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry and entry[0] == signature:
+                self._entries[uri] = entry[:3] + (generation,)
+                self._entries.move_to_end(uri)
+                self.hits += 1
+                return entry[2]
+            if entry:
+                self.reloads += 1
+            else:
+                self.misses += 1
+
+        with open(uri, mode) as file, metrics.timer('bn_resource_load_seconds', format=path.splitext(uri)[1][1:]):
+            data = loader(file)
+
+        with self._lock:
+            self._discard(uri)
+            if st.st_size <= self.max_bytes:
+                self._entries[uri] = (signature, st.st_size, data, generation)
+                self._size += st.st_size
+                while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+        }
+
+    def _discard(self, uri):
+        entry = self._entries.pop(uri, None)
+        if entry:
+            self._size -= entry[1]
+
+
+class StationsIndex():
+    """
+    productIdentifier -> (source_id, feature) index over the stations lists of all sources.
+    The stations lists come from the catalog cache: an index is rebuilt only for the sources whose list object changed
+    (i.e. was reloaded by the cache) since the last build.
+    """
+
+    def __init__(self):
+        self._catalogs = {}  # source_id -> stations list object the index was built from
+        self._by_source = {}  # source_id -> {productIdentifier: feature}
+        self._merged = {}  # productIdentifier -> (source_id, feature)
+        self._lock = threading.Lock()
+
+    def update(self, catalogs):
+        """
+        Rebuild the index if some stations lists changed
+        :param catalogs: ordered dict source_id -> stations list. If a station id is present in several sources, the
+        first source wins
+        :return: the index
+        """
+        with self._lock:
+            if _same_catalogs(catalogs, self._catalogs):
+                return self
+            by_source = {}
+            for source_id, catalog in catalogs.items():
+                if self._catalogs.get(source_id) is catalog:
+                    by_source[source_id] = self._by_source[source_id]
+                else:
+                    by_source[source_id] = {f['properties']['productIdentifier']: f for f in catalog['features']}
+            merged = {}
+            for source_id, features in by_source.items():
+                for station_id, feature in features.items():
+                    merged.setdefault(station_id, (source_id, feature))
+            self._catalogs = dict(catalogs)
+            self._by_source = by_source
+            self._merged = merged
+            return self
+
+    def find(self, station_id, source_id=None):
+        """
+        :param station_id: the id given in productIdentifier field
+        :param source_id: restrict the search to this source
+        :return: (source_id, feature) tuple, None if not found
+        """
+        if source_id is None:
+            return self._merged.get(station_id)
+        feature = self._by_source.get(source_id, {}).get(station_id)
+        return (source_id, feature) if feature else None
+
+
+class StationsSpatialIndex():
+    """
+    Spatial index over the stations of all sources. Rebuilt when a stations list changes
+    """
+
+    def __init__(self):
+        self._catalogs = {}
+        self.features = []
+        self.positions = {}  # productIdentifier -> position of its first feature
+        self.index = spatial.SpatialIndex([], [])
+        self._lock = threading.Lock()
+
+    def update(self, catalogs):
+        """
+        Rebuild the index if some stations lists changed
+        :param catalogs: ordered dict source_id -> stations list
+        :return: the index
+        """
+        with self._lock:
+            if _same_catalogs(catalogs, self._catalogs):
+                return self
+            features = [f for catalog in catalogs.values() for f in catalog['features']]
+            coordinates = numpy.array([f['geometry']['coordinates'][:2] for f in features],
+                                      dtype=numpy.float64).reshape(-1, 2)
+            self.index = spatial.SpatialIndex(coordinates[:, 0], coordinates[:, 1])
+            self.features = features
+            positions = {}
+            for position, f in enumerate(features):
+                positions.setdefault(f['properties']['productIdentifier'], position)
+            self.positions = positions
+            self._catalogs = dict(catalogs)
+            return self
+
+
+class StationsFilterIndex():
+    """
+    Filtering index (see filtering.FeaturesFilter) over the concatenated stations lists. Rebuilt when a stations list
+    changes
+    """
+
+    def __init__(self):
+        self._catalogs = {}
+        self.filter = filtering.FeaturesFilter([])
+        self._lock = threading.Lock()
+
+    def update(self, catalogs):
+        """
+        Rebuild the index if some stations lists changed
+        :param catalogs: ordered dict source_id -> stations list
+        :return: the index
+        """
+        with self._lock:
+            if _same_catalogs(catalogs, self._catalogs):
+                return self
+            self.filter = filtering.FeaturesFilter([f for catalog in catalogs.values() for f in catalog['features']])
+            self._catalogs = dict(catalogs)
+            return self
+
+
+def _is_up_to_date(derived, original):
+    """
+    Tells whether a file derived from another one (e.g. a binary cache) exists and is at least as recent as the original
+    :param derived: derived file path
+    :param original: original file path
+    :return:
+    """
+    try:
+        derived_mtime = os.stat(derived).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    try:
+        return derived_mtime >= os.stat(original).st_mtime_ns
+    except FileNotFoundError:
+        return True
+
+
+def _same_catalogs(catalogs, other):
+    """
+    Tells whether two source_id -> stations list dicts reference the same list objects
+    """
+    return list(catalogs) == list(other) and all(c is other[k] for k, c in catalogs.items())
+
+
+@contextmanager
+def atomic_open(filename, mode='w'):
+    """
+    Open a temporary file, next to filename, that replaces filename once it has been successfully written. Readers
+    never see a partially written file
+    :param filename: destination file path
+    :param mode: opening mode ('w' or 'wb')
+    :return: the file object
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(filename), prefix='.{}.'.format(path.basename(filename)))
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_if_changed(filename, data):
+    """
+    Write data to filename (atomically), unless the file already has this content: it is then left untouched, so that
+    the readers watching its signature don't reload it
+    :param filename: destination file path
+    :param data: bytes
+    :return: True if the file was written
+    """
+    try:
+        if os.stat(filename).st_size == len(data):
+            with open(filename, 'rb') as file:
+                if file.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+    with atomic_open(filename, 'wb') as file:
+        file.write(data)
+    return True
+
+
+def write_series(filename, series):
+    """
+    Write a series array (see parsing.txt2series) as binary .npy file
+    :param filename:
+    :param series:
+    :return:
+    """
+    with atomic_open(filename, 'wb') as file:
+        numpy.save(file, numpy.ascontiguousarray(series, dtype=numpy.float64))
+
+
+def read_series(filename):
+    """
+    Memory-map a series array written by write_series
+    :param filename:
+    :return: read-only series array
+    """
+    return numpy.load(filename, mmap_mode='r')
+
+
+def load_series(series_file, data_file):
+    """
+    Get a station's series array, from its binary series file if it is up to date, else from its TXT data file
+    :param series_file: binary series file path
+    :param data_file: TXT data file path
+    :return: series array
+    """
+    if _is_up_to_date(series_file, data_file):
+        with metrics.timer('bn_resource_load_seconds', format='npy'):
+            return read_series(series_file)
+    with metrics.timer('bn_resource_load_seconds', format='txt'):
+        return parsing.txt2series(data_file)
 
 
 class IoHelper():
@@ -11,25 +310,61 @@ class IoHelper():
     def __init__(self, flask_app=None):
         self.app = flask_app
         root_path = '/mnt/data' # default
+        cache_max_entries = 16
+        cache_max_bytes = 256 * 1024 * 1024
+        generation_check_interval = 5
         if self.app:
             root_path = self.app.config['STORAGE_PATH']
+            cache_max_entries = int(self.app.config['CATALOG_CACHE_MAX_ENTRIES'])
+            cache_max_bytes = int(self.app.config['CATALOG_CACHE_MAX_BYTES'])
+            generation_check_interval = float(self.app.config['GENERATION_CHECK_INTERVAL'])
         self.paths = {
             'root': root_path,
             'sources.folder' : path.join(root_path, 'sources', '{source_id}'),
             'stations.folder' : path.join(root_path, 'sources', '{source_id}', 'stations'),
             'txt.folder' : path.join(root_path, 'sources', '{source_id}', 'stations', 'txt'),
             'png.folder' : path.join(root_path, 'sources', '{source_id}', 'stations', 'thumbnails'),
+            'bin.folder' : path.join(root_path, 'sources', '{source_id}', 'stations', 'bin'),
             'stations.list' : path.join(root_path, 'sources', '{source_id}', 'stations', 'stations.json'),
+            'stations.statistics' : path.join(root_path, 'sources', '{source_id}', 'stations', 'statistics.json'),
+            'stations.manifest' : path.join(root_path, 'sources', '{source_id}', 'stations', 'manifest.json'),
             'stations.data' : path.join(root_path, 'sources', '{source_id}', 'stations', 'txt',
                                         '{station_id}.txt'),
+            'stations.series' : path.join(root_path, 'sources', '{source_id}', 'stations', 'bin',
+                                        '{station_id}.npy'),
+            'stations.series.level' : path.join(root_path, 'sources', '{source_id}', 'stations', 'bin',
+                                                '{station_id}.{level}.npy'),
+            'stations.png' : path.join(root_path, 'sources', '{source_id}', 'stations', 'thumbnails',
+                                        '{station_id}.png'),
+            'stations.svg' : path.join(root_path, 'sources', '{source_id}', 'stations', 'thumbnails',
+                                        '{station_id}.svg'),
+            'thumbnails.cache' : path.join(root_path, 'cache', 'thumbnails'),
+            'merged.list' : path.join(root_path, 'stations.json'),
+            'merged.catalog' : path.join(root_path, 'stations.bin'),
+            'generation' : path.join(root_path, 'generation.json'),
             'stations.png.url' : path.join('/static', 'sources', '{source_id}', 'stations', 'thumbnails',
                                         '{station_id}.png'),
+            'stations.svg.url' : path.join('/static', 'sources', '{source_id}', 'stations', 'thumbnails',
+                                        '{station_id}.svg'),
         }
+        self.catalog_cache = CatalogCache(cache_max_entries, cache_max_bytes)
+        self.stations_index = StationsIndex()
+        self.stations_spatial_index = StationsSpatialIndex()
+        # filtering indexes, by source id (None for the stations of all sources)
+        self.stations_filter_indexes = {}
+        self._merged_catalog = None
+        self._merged_catalog_signature = None
+        self._merged_catalog_generation = None
+        self._merged_catalog_lock = threading.Lock()
+        self.generation_check_interval = generation_check_interval
+        self._generation = None
+        self._generation_checked = None
 
 
     def resource_get(self, src, res, id=''):
         """
         Get the resource (res) locally if possible.
+        The stations lists are served from an in-process cache: the returned object is shared and must not be modified.
         :param src: source definition
         :param res: the resource to get
         :return:
@@ -37,11 +372,226 @@ class IoHelper():
         if res == 'list':
             uri = self.paths.get('stations.list').format(source_id = src['id'])
             #uri = path.join(base_path, 'sources', src['id'], 'stations', 'stations.json')
-            with open(uri) as json_file:
-                json_local = json.load(json_file)
-                return json_local
+            return self.catalog_cache.get(uri, generation=self.generation())
         elif res == 'data':
-            # TODO error-check if id doesn't exist
-            uri = self.paths.get('stations.data').format(source_id = src['id'], station_id = id)
-            #uri = path.join(base_path, 'sources', src['id'], 'stations', 'txt', '{id}.txt'.format(id=id))
-            return parsing.txt2data_vectors(uri)
+            series = self.series_get(src, id)
+            if series is None:
+                return None
+            return parsing.series2data_vectors(series)
+        elif res == 'statistics':
+            # station id -> statistics, produced by prepare_stations.py
+            uri = self.paths.get('stations.statistics').format(source_id = src['id'])
+            try:
+                return self.catalog_cache.get(uri, generation=self.generation())
+            except FileNotFoundError as e:
+                return None
+
+    def series_get(self, src, station_id):
+        """
+        Get a station's series array (see parsing.txt2series)
+        :param src: source definition
+        :param station_id: the id given in productIdentifier field
+        :return: series array, None if the station has no data file
+        """
+        uri = self.paths.get('stations.data').format(source_id = src['id'], station_id = station_id)
+        series_uri = self.paths.get('stations.series').format(source_id = src['id'], station_id = station_id)
+        try:
+            return load_series(series_uri, uri)
+        except FileNotFoundError as e:
+            return None
+
+    def series_level(self, src, station_id, level):
+        """
+        Get a station's series at a given resolution level
+        :param src: source definition
+        :param station_id: the id given in productIdentifier field
+        :param level: 'raw' or one of series.AGGREGATION_LEVELS
+        :return: series array for 'raw', else aggregated series array (see series.aggregate), from its binary file
+        if up to date, else computed from the series. None if the station has no data file
+        """
+        if level == 'raw':
+            return self.series_get(src, station_id)
+        uri = self.paths.get('stations.data').format(source_id = src['id'], station_id = station_id)
+        level_uri = self.paths.get('stations.series.level').format(source_id = src['id'], station_id = station_id,
+                                                                   level = level)
+        if _is_up_to_date(level_uri, uri):
+            with metrics.timer('bn_resource_load_seconds', format='npy'):
+                return read_series(level_uri)
+        series = self.series_get(src, station_id)
+        if series is None:
+            return None
+        return series_utils.aggregate(series, level)
+
+    def data_signature(self, src, station_id):
+        """
+        :param src: source definition
+        :param station_id: the id given in productIdentifier field
+        :return: a string identifying the current version of the station's data file, None if it doesn't exist
+        """
+        uri = self.paths.get('stations.data').format(source_id = src['id'], station_id = station_id)
+        try:
+            st = os.stat(uri)
+        except FileNotFoundError:
+            return None
+        return '{:x}{:x}'.format(st.st_mtime_ns, st.st_size)
+
+    def series_tail(self, src, station_id, n):
+        """
+        Get the last observations of a station, without loading its whole series: sliced from the memory-mapped
+        binary series file if it is up to date, else read backwards from the end of the TXT data file
+        :param src: source definition
+        :param station_id: the id given in productIdentifier field
+        :param n: number of observations
+        :return: series array, None if the station has no data file
+        """
+        uri = self.paths.get('stations.data').format(source_id = src['id'], station_id = station_id)
+        series_uri = self.paths.get('stations.series').format(source_id = src['id'], station_id = station_id)
+        try:
+            if _is_up_to_date(series_uri, uri):
+                with metrics.timer('bn_resource_load_seconds', format='npy'):
+                    series = read_series(series_uri)
+                return series[:, max(series.shape[1] - n, 0):]
+            with metrics.timer('bn_resource_load_seconds', format='txt'):
+                return parsing.txt2series_tail(uri, n)
+        except FileNotFoundError as e:
+            return None
+
+    def station_statistics(self, src, station_id):
+        """
+        Get a station's statistics (see series.statistics), from the source's statistics file, else computed from its
+        series
+        :param src: source definition
+        :param station_id: the id given in productIdentifier field
+        :return: statistics dict, None if the station has no data
+        """
+        stats = (self.resource_get(src, 'statistics') or {}).get(station_id)
+        if stats is not None:
+            return stats
+        series = self.series_get(src, station_id)
+        if series is None:
+            return None
+        return series_utils.statistics(series)
+
+    def station_find(self, srcs, station_id, source_id=None):
+        """
+        Look up a station by id, using the stations index
+        :param srcs: sources definitions (dict source_id -> source)
+        :param station_id: the id given in productIdentifier field
+        :param source_id: restrict the search to this source
+        :return: (source_id, feature) tuple, None if not found. The feature is shared and must not be modified.
+        """
+        if source_id is None:
+            merged = self.merged_catalog()
+            found = merged.find(station_id) if merged else None
+            if found:
+                return found
+        return self.stations_index.update(self.catalogs(srcs)).find(station_id, source_id)
+
+    def stations_nearby(self, srcs, lon, lat, limit=None, radius=None, exclude=None):
+        """
+        Look up the stations close to a point, using the spatial index
+        :param srcs: sources definitions (dict source_id -> source)
+        :param lon:
+        :param lat:
+        :param limit: max number of stations
+        :param radius: max distance, in km
+        :param exclude: id (productIdentifier) of the station to leave out of the results (e.g. the reference station).
+        Its first feature, the one found by station_find, is left out
+        :return: list of (feature, distance in km) tuples, by order of distance. The features are shared and must not
+        be modified.
+        """
+        merged = self.merged_catalog()
+        if merged:
+            features, index = merged.features, merged.spatial_index
+            excluded = merged.position(exclude) if exclude is not None else None
+        else:
+            spatial_index = self.stations_spatial_index.update(self.catalogs(srcs))
+            features, index = spatial_index.features, spatial_index.index
+            excluded = spatial_index.positions.get(exclude)
+        # by position: the merged catalog decodes the features on access
+        skip = (lambda i: i == excluded) if excluded is not None else None
+        if radius is not None:
+            indices, distances = index.within(lon, lat, radius)
+            if skip:
+                keep = indices != excluded
+                indices, distances = indices[keep], distances[keep]
+            if limit is not None:
+                indices, distances = indices[:limit], distances[:limit]
+        else:
+            indices, distances = index.nearest(lon, lat, limit, exclude=skip)
+        return [(features[i], float(d)) for i, d in zip(indices, distances)]
+
+    def catalogs(self, srcs):
+        """
+        :param srcs: sources definitions (dict source_id -> source)
+        :return: ordered dict source_id -> stations list, for the sources that have one
+        """
+        catalogs = OrderedDict()
+        for src_id, src in srcs.items():
+            try:
+                catalogs[src_id] = self.resource_get(src, 'list')
+            except FileNotFoundError:
+                # this source has not been prepared yet
+                pass
+        return catalogs
+
+    def stations_filter(self, srcs, source_id=None):
+        """
+        Get the filtering index of a stations list
+        :param srcs: sources definitions
+        :param source_id: source id. None for the stations of all sources (the merged stations list if available)
+        :return: filtering.FeaturesFilter
+        """
+        if source_id is not None:
+            catalogs = {source_id: self.resource_get(srcs[source_id], 'list')}
+        else:
+            merged = self.merged_catalog()
+            catalogs = {None: merged.catalog} if merged else self.catalogs(srcs)
+        index = self.stations_filter_indexes.get(source_id)
+        if index is None:
+            index = self.stations_filter_indexes.setdefault(source_id, StationsFilterIndex())
+        return index.update(catalogs).filter
+
+    def merged_catalog(self):
+        """
+        Get the merged stations list produced by prepare_stations.py, memory-mapped (shared by the processes, see
+        shared_catalog.py). Mapped again when the file changes
+        :return: shared_catalog.SharedCatalog, None if not available
+        """
+        generation = self.generation()
+        merged = self._merged_catalog
+        if generation is not None and merged is not None and self._merged_catalog_generation == generation:
+            return merged
+        filename = self.paths['merged.catalog']
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        signature = (st.st_mtime_ns, st.st_size)
+        with self._merged_catalog_lock:
+            if self._merged_catalog is None or self._merged_catalog_signature != signature:
+                try:
+                    with metrics.timer('bn_resource_load_seconds', format='bin'):
+                        self._merged_catalog = SharedCatalog(filename)
+                except (FileNotFoundError, ValueError):
+                    return None
+                self._merged_catalog_signature = signature
+            self._merged_catalog_generation = generation
+            return self._merged_catalog
+
+    def generation(self):
+        """
+        Get the data generation published by prepare_stations.py, incremented when the stations lists, statistics or
+        merged catalog change. The generation file is read at most every generation_check_interval seconds; until the
+        generation changes, the cached stations lists and merged catalog are served without checking their files
+        :return: generation number, None if not published (the files are then checked on every access)
+        """
+        now = time.monotonic()
+        if self._generation_checked is None or now - self._generation_checked >= self.generation_check_interval:
+            try:
+                with open(self.paths['generation']) as file:
+                    self._generation = json.load(file)['generation']
+            except (FileNotFoundError, ValueError, KeyError):
+                self._generation = None
+            self._generation_checked = now
+        return self._generation
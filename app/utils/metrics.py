@@ -0,0 +1,359 @@
+# encoding: utf-8
+"""Request and cache metrics, exposed in the Prometheus text format
+
+Every process records its own counters and histograms in memory and periodically writes them to its own file
+(metrics-<pid>.json) in a folder shared by the uwsgi workers. The metrics endpoint sums the files of all the processes,
+so the numbers don't depend on the worker answering the scrape. The counters of the caches (see register_collector)
+are read when the process writes its file.
+As in the multiprocess mode of prometheus_client, the metrics of the processes that are not running anymore (e.g.
+recycled uwsgi workers) are kept: their files are folded into an archive file (metrics.archive.json), summed with the
+files of the running processes, so that the exposed counters never decrease. A process whose pid was used by a previous
+one archives its predecessor's file before writing its own.
+
+uwsgi forks its workers without running the os.register_at_fork hooks (unless --py-call-osafterfork is set): the
+metrics are also reset by a uwsgidecorators.postfork hook, so that the workers don't report the observations of the
+master process (e.g. the loading of the merged catalog).
+"""
+
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from os import path
+
+try:
+    import uwsgidecorators
+except ImportError:
+    # not running under uwsgi
+    uwsgidecorators = None
+
+# seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# bytes
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000, 100000000]
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics():
+    """
+    Counters and histograms of the current process
+    """
+
+    def __init__(self):
+        self.folder = None
+        self.flush_interval = 5.0
+        self._buckets = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._reset()
+        # forked processes (e.g. uwsgi workers) start from scratch
+        os.register_at_fork(after_in_child=self._after_fork)
+        if uwsgidecorators:
+            uwsgidecorators.postfork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._counters = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self._histograms = {}
+        self._last_flush = time.monotonic()
+        # False until the process' file is written: an existing one was left by a previous process with the same pid
+        self._file_owned = False
+        # the collectors counters inherited from the parent process are not ours
+        self._collectors_baseline = self._collect()
+
+    def configure(self, folder, flush_interval=5.0):
+        """
+        :param folder: folder shared by the processes. None to keep the metrics in the process only
+        :param flush_interval: min delay between two writes of the process' file, in seconds
+        """
+        self.folder = folder
+        self.flush_interval = flush_interval
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def histogram(self, name, buckets, help=''):
+        """
+        Declare a histogram
+        :param name: metric name
+        :param buckets: upper bounds of the buckets
+        :param help: description
+        """
+        self._buckets[name] = list(buckets)
+        self._help[name] = help
+
+    def counter(self, name, help=''):
+        """
+        Declare a counter
+        """
+        self._help[name] = help
+
+    def register_collector(self, collector):
+        """
+        :param collector: function returning a list of (counter name, labels dict, cumulated value) tuples
+        """
+        self._collectors.append(collector)
+        with self._lock:
+            for name, labels, value in collector():
+                key = (name, _labels_key(labels))
+                self._collectors_baseline[key] = self._collectors_baseline.get(key, 0) + value
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            key = (name, _labels_key(labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            key = (name, _labels_key(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self._buckets[name]) + 1), 0.0, 0]
+            counts = histogram[0]
+            for i, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the duration of a block in a histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _collect(self):
+        values = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                key = (name, _labels_key(labels))
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def snapshot(self):
+        """
+        :return: JSON-serializable state of the process
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            for key, value in self._collect().items():
+                counters[key] = counters.get(key, 0) + value - self._collectors_baseline.get(key, 0)
+            return dict(_as_snapshot(counters, self._histograms), pid=os.getpid())
+
+    def _filename(self):
+        return path.join(self.folder, 'metrics-{}.json'.format(os.getpid()))
+
+    def _write(self, filename, snapshot):
+        # not io_utils.atomic_open: io_utils records its load times here
+        fd, tmp = tempfile.mkstemp(dir=self.folder, prefix='.metrics.')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(snapshot, file)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @contextmanager
+    def _folder_lock(self):
+        """
+        Lock the folder against the other processes archiving files
+        """
+        with open(path.join(self.folder, '.metrics.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _archive(self, filenames):
+        """
+        Fold files of processes that are not running anymore into the archive file, and remove them. To be called with
+        the folder locked
+        """
+        archive = path.join(self.folder, 'metrics.archive.json')
+        snapshots = []
+        for filename in [archive] + filenames:
+            try:
+                with open(filename) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+        counters, histograms = _sum(snapshots)
+        self._write(archive, _as_snapshot(counters, histograms))
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        """
+        Write the process' file
+        """
+        if not self.folder:
+            return
+        snapshot = self.snapshot()
+        filename = self._filename()
+        if not self._file_owned:
+            if path.exists(filename):
+                with self._folder_lock():
+                    self._archive([filename])
+            self._file_owned = True
+        self._write(filename, snapshot)
+        self._last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        """
+        Write the process' file if it was not written for flush_interval seconds
+        """
+        if self.folder and time.monotonic() - self._last_flush >= self.flush_interval:
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def aggregate(self):
+        """
+        Sum the metrics of all the processes: the files of the running ones, and the archive file, into which the files
+        of the other ones are folded first
+        :return: (counters, histograms) dicts, by (name, labels)
+        """
+        if not self.folder:
+            return _sum([self.snapshot()])
+        self.flush()
+        with self._folder_lock():
+            snapshots, finished = [], []
+            for filename in glob.glob(path.join(self.folder, 'metrics-*.json')):
+                try:
+                    with open(filename) as file:
+                        snapshot = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                if _is_running(snapshot.get('pid')):
+                    snapshots.append(snapshot)
+                else:
+                    finished.append(filename)
+            if finished:
+                self._archive(finished)
+            try:
+                with open(path.join(self.folder, 'metrics.archive.json')) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                pass
+        return _sum(snapshots)
+
+    def exposition(self):
+        """
+        :return: the metrics of all the processes, in the Prometheus text format
+        """
+        counters, histograms = self.aggregate()
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if self._help.get(name):
+                    lines.append('# HELP {} {}'.format(name, self._help[name]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels) + '}'
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulated = 0
+            for bound, bucket_count in zip(self._buckets.get(name, []) + ['+Inf'], counts):
+                cumulated += bucket_count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bound)]), cumulated))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _sum(snapshots):
+    """
+    :param snapshots: processes snapshots (see Metrics.snapshot)
+    :return: (counters, histograms) dicts, by (name, labels)
+    """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total, count in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            previous = histograms.get(key)
+            if previous is None:
+                histograms[key] = [list(counts), total, count]
+            elif len(previous[0]) == len(counts):
+                previous[0] = [a + b for a, b in zip(previous[0], counts)]
+                previous[1] += total
+                previous[2] += count
+    return counters, histograms
+
+
+def _as_snapshot(counters, histograms):
+    """
+    :return: the snapshot of summed counters and histograms (see _sum)
+    """
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), counts, total, count]
+                       for (name, labels), (counts, total, count) in histograms.items()],
+    }
+
+
+def _is_running(pid):
+    """
+    :param pid: process id
+    :return: True if the process is running
+    """
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, as another user
+        pass
+    return True
+
+
+# metrics of the current process
+metrics = Metrics()
+metrics.histogram('bn_http_request_duration_seconds', LATENCY_BUCKETS,
+                  'Time spent answering the requests, by endpoint (streamed bodies excluded)')
+metrics.histogram('bn_http_response_size_bytes', SIZE_BUCKETS, 'Size of the responses bodies, by endpoint')
+metrics.histogram('bn_resource_load_seconds', LATENCY_BUCKETS,
+                  'Time spent loading the station files, by format: json (stations lists), txt (data parsing), '
+                  'npy (binary series)')
+metrics.counter('bn_cache_requests_total', 'Cache lookups, by cache and result')
@@ -3,8 +3,11 @@
 
 """
 
+import io
 import os
 import re
+import warnings
+import numpy
 from dateutil import parser
 from datetime import datetime
 
@@ -28,6 +31,19 @@ capitalized_metadata=['river', 'lake', 'basin', 'country']
 HYDROWEB_v1 = 'v1'
 HYDROWEB_v2 = 'v2'
 
+# Rows of the columnar series array (see txt2series): epoch timestamp (s, UTC), water height, uncertainty
+SERIES_TIME = 0
+SERIES_H = 1
+SERIES_UNCERTAINTY = 2
+
+# Data columns read from the TXT files
+_TXT_COLUMNS_DTYPE = numpy.dtype([
+    ('date', 'datetime64[D]'),
+    ('time', 'S5'),
+    ('h', numpy.float64),
+    ('uncertainty', numpy.float64),
+])
+
 
 def txt2geojson(path):
     '''
@@ -45,7 +61,7 @@ def txt2geojson(path):
 
     # Read header
     try:
-        # Opening the file in binary mode to get optimized access to last line directly (see below)
+        # Opening the file in binary mode to get optimized access to last line directly (see reverse_lines)
         with open(path, "rb") as file:
             # read header (first line)
             line = file.readline().decode()
@@ -68,6 +84,7 @@ def txt2geojson(path):
 
                 # extract start and last date
                 # get start date (will be in the lien read above (last in the loop)
+                data_start = file.tell() - len(line.encode())
                 while line:
                     if not line.lstrip().startswith('#'):
                         line_data = _txt_parse_line_data(line, HYDROWEB_v2)
@@ -76,12 +93,10 @@ def txt2geojson(path):
                     line = file.readline().decode()
 
                 # get last date
-                file.seek(-2, os.SEEK_END)
-                while file.read(1) != b'\n':
-                    file.seek(-2, os.SEEK_CUR)
-                line = file.readline().decode()
-                line_data = _txt_parse_line_data(line, HYDROWEB_v2)
-                header['completion_date'] = line_data['timestamp_iso']
+                line = _last_data_line(file, data_start)
+                if line:
+                    line_data = _txt_parse_line_data(line, HYDROWEB_v2)
+                    header['completion_date'] = line_data['timestamp_iso']
 
                 # fill metadata dict using the header
                 metadata = _v2_header_to_metadata(header, metadata)
@@ -90,6 +105,7 @@ def txt2geojson(path):
                 header = _txt_parse_header(line)
                 # extract start and last date
                 # get start date
+                data_start = file.tell()
                 line = file.readline().decode()
                 while line:
                     if not line.lstrip().startswith('#'):
@@ -99,12 +115,10 @@ def txt2geojson(path):
                     line = file.readline().decode()
 
                 # get last date
-                file.seek(-2, os.SEEK_END)
-                while file.read(1) != b'\n':
-                    file.seek(-2, os.SEEK_CUR)
-                line = file.readline().decode()
-                line_data = _txt_parse_line_data(line, HYDROWEB_v1)
-                header['completion_date'] = line_data['timestamp_iso']
+                line = _last_data_line(file, data_start)
+                if line:
+                    line_data = _txt_parse_line_data(line, HYDROWEB_v1)
+                    header['completion_date'] = line_data['timestamp_iso']
                 metadata = _v1_header_to_metadata(header, metadata)
 
             # create geojson feature out of collected metadata
@@ -113,6 +127,48 @@ def txt2geojson(path):
         return None
 
 
+def reverse_lines(file, start=0, block_size=8192):
+    """
+    Iterate over the lines of a file opened in binary mode, from the last one, reading it backwards by blocks.
+    A trailing newline yields an empty line first
+    :param file: file opened in binary mode
+    :param start: offset of the first line to read
+    :param block_size: read size
+    :return: generator of lines (bytes, without the newline)
+    """
+    file.seek(0, os.SEEK_END)
+    position = file.tell()
+    remainder = b''
+    while position > start:
+        size = min(block_size, position - start)
+        position -= size
+        file.seek(position)
+        lines = (file.read(size) + remainder).split(b'\n')
+        remainder = lines[0]
+        for line in reversed(lines[1:]):
+            yield line
+    yield remainder
+
+
+def _data_lines_backwards(file, start):
+    """
+    :return: generator of the data lines (bytes), from the last one, skipping the blank and comment lines
+    """
+    for line in reverse_lines(file, start):
+        if line.strip() and not line.lstrip().startswith(b'#'):
+            yield line
+
+
+def _last_data_line(file, start):
+    """
+    :param file: file opened in binary mode
+    :param start: offset of the first data line
+    :return: last data line of the file (str), None if there is no data line
+    """
+    line = next(_data_lines_backwards(file, start), None)
+    return line.decode() if line is not None else None
+
+
 def _v1_header_to_metadata(header, metadata):
     """
     v2 and v1 produce differently formatted headers. We use an intermadiate metadata dict, that allows to
@@ -188,16 +244,91 @@ def txt2data_vectors(path):
     :return:
     """
     try:
-        data = txt2array(path)
-        x, y = zip(*data)
-        return {
-            'dates': x,
-            'h': y
-        }
+        return series2data_vectors(txt2series(path))
     except FileNotFoundError as e:
         return None
 
 
+def txt2series(path):
+    """
+    Convert data from hydroweb (v1 or v2) TXT format to a columnar numpy array.
+    The whole file is parsed in one pass by numpy.loadtxt: v1 files (';'-separated, one-line header) are first turned
+    into whitespace-separated text, and the '#' lines (v2 header) are skipped as comments.
+    :param path: file path
+    :return: float64 array of shape (3, n), in chronological order. Rows are indexed by SERIES_TIME (epoch timestamp
+    in seconds, UTC), SERIES_H (water height) and SERIES_UNCERTAINTY
+    """
+    with open(path) as file:
+        text = file.read()
+    if text.split('\n', 1)[0].lstrip().startswith('#'):
+        return _text2series(text, HYDROWEB_v2)
+    # skip the v1 header line
+    return _text2series(text.split('\n', 1)[1] if '\n' in text else '', HYDROWEB_v1)
+
+
+def txt2series_tail(path, n):
+    """
+    Get the last observations of a hydroweb (v1 or v2) TXT file, reading it backwards from its end
+    :param path: file path
+    :param n: number of observations
+    :return: series array (see txt2series) of the last n observations
+    """
+    with open(path, 'rb') as file:
+        first_line = file.readline()
+        if first_line.lstrip().startswith(b'#'):
+            file_version, start = HYDROWEB_v2, 0
+        else:
+            file_version, start = HYDROWEB_v1, file.tell()
+        lines = []
+        if n > 0:
+            for line in _data_lines_backwards(file, start):
+                lines.append(line)
+                if len(lines) >= n:
+                    break
+    return _text2series(b'\n'.join(reversed(lines)).decode(), file_version)
+
+
+def _text2series(text, file_version):
+    """
+    Parse data lines (header excluded, v2 comment lines allowed)
+    :param text: data lines
+    :param file_version: HYDROWEB_v1 or HYDROWEB_v2
+    :return: series array (see txt2series)
+    """
+    if file_version == HYDROWEB_v2:
+        # HYDROWEB_v2 columns: date time height uncertainty ...
+        usecols = (0, 1, 2, 3)
+    else:
+        # HYDROWEB_v1 columns: decimal year ; date ; time ; height ; uncertainty ; ...
+        usecols = (1, 2, 3, 4)
+        text = text.replace(';', ' ').replace('/', '-')
+
+    with warnings.catch_warnings():
+        # a station without data is not an error
+        warnings.simplefilter('ignore', UserWarning)
+        data = numpy.loadtxt(io.StringIO(text), dtype=_TXT_COLUMNS_DTYPE, usecols=usecols, comments='#', ndmin=1)
+
+    series = numpy.empty((3, len(data)), dtype=numpy.float64)
+    series[SERIES_TIME] = data['date'].astype(numpy.int64) * 86400 + _hhmm_to_seconds(data['time'])
+    series[SERIES_H] = data['h']
+    series[SERIES_UNCERTAINTY] = data['uncertainty']
+    if numpy.any(numpy.diff(series[SERIES_TIME]) < 0):
+        series = series[:, numpy.argsort(series[SERIES_TIME], kind='stable')]
+    return series
+
+
+def series2data_vectors(series):
+    """
+    Produces, from a columnar series array (see txt2series), the same dict as txt2data_vectors
+    :param series: series array
+    :return:
+    """
+    return {
+        'dates': _format_timestamps(series[SERIES_TIME]),
+        'h': series[SERIES_H].tolist()
+    }
+
+
 def txt2array(path):
     '''
     Convert data from hydroweb TXT format to numpy array (for graphs)
@@ -205,27 +336,48 @@ def txt2array(path):
     :param path:
     :return: list of (time, value) tuples
     '''
-    #TODO: check if we get performance improvement using numpy.fromregex to read from file
-    with open(path) as file:
-        # drop header (first line)
-        line = file.readline()
-        file_version = HYDROWEB_v1
-        if line.lstrip().startswith('#'):
-            file_version = HYDROWEB_v2
-
-
-        # parse the rest
-        line = file.readline()
-        data = []
-        while line:
-            if not line.lstrip().startswith('#'):
-                line_data = _txt_parse_line_data(line, file_version)
-                data.append((line_data['timestamp_iso'],
-                             float(line_data['water_surface_height_above_reference_datum'])
-                             )
-                            )
-            line = file.readline()
-    return data
+    data = series2data_vectors(txt2series(path))
+    return list(zip(data['dates'], data['h']))
+
+
+def _format_timestamps(seconds):
+    """
+    Format epoch timestamps as 'YYYY-MM-DD HH:MM' strings. Vectorized: the characters are computed as an array of
+    unicode code points, viewed as strings
+    :param seconds: epoch timestamps array
+    :return: list of str
+    """
+    seconds = numpy.asarray(seconds).astype(numpy.int64)
+    days = (seconds // 86400).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    year = months.astype('datetime64[Y]').astype(numpy.int64) + 1970
+    month = months.astype(numpy.int64) % 12 + 1
+    day = (days - months).astype(numpy.int64) + 1
+    minutes = seconds % 86400 // 60
+    chars = numpy.empty((len(seconds), 16), dtype=numpy.uint32)
+    for i, (value, digits) in zip((0, 5, 8, 11, 14), ((year, 4), (month, 2), (day, 2), (minutes // 60, 2),
+                                                      (minutes % 60, 2))):
+        for d in range(digits):
+            chars[:, i + d] = value // 10 ** (digits - 1 - d) % 10 + ord('0')
+    chars[:, [4, 7]] = ord('-')
+    chars[:, 10] = ord(' ')
+    chars[:, 13] = ord(':')
+    return chars.view('<U16').reshape(-1).tolist()
+
+
+def _hhmm_to_seconds(times):
+    """
+    Convert HH:MM times to seconds
+    :param times: bytes array
+    :return: int64 array
+    """
+    times = numpy.ascontiguousarray(times, dtype='S5')
+    digits = times.view(numpy.uint8).reshape(-1, 5).astype(numpy.int64) - ord('0')
+    if not (digits[:, 2] == ord(':') - ord('0')).all():
+        # not zero-padded
+        return numpy.array([int(hh) * 3600 + int(mm) * 60 for hh, mm in (t.split(b':') for t in times)],
+                           dtype=numpy.int64)
+    return (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
 
 
 def _txt_parse_header(line):
@@ -0,0 +1,189 @@
+# encoding: utf-8
+"""Pre-serialized, pre-compressed JSON responses, and streamed GeoJSON responses
+
+Documents that only change with the station data (e.g. the stations lists) are serialized once, stored as raw, gzip and
+brotli bytes, and served as is, with a strong ETag, until the objects they are built from change.
+Flask-Compress leaves these responses alone, since they already carry a Content-Encoding header.
+
+Feature collections can also be streamed, feature by feature, so that the serialized document is never held in memory.
+"""
+
+import functools
+import gzip
+import hashlib
+import threading
+
+from flask import Response, current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class PrecompressedDocument():
+    """
+    A JSON document, serialized and compressed
+    """
+
+    def __init__(self, version, body, gzip_level=9, brotli_quality=9):
+        """
+        :param version: tuple of the objects the document was built from
+        :param body: serialized document
+        :param gzip_level:
+        :param brotli_quality:
+        """
+        self.version = version
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.bodies = {
+            'identity': body,
+            'gzip': gzip.compress(body, compresslevel=gzip_level),
+        }
+        if brotli:
+            self.bodies['br'] = brotli.compress(body, quality=brotli_quality)
+
+    def is_version(self, version):
+        return len(version) == len(self.version) and all(a is b for a, b in zip(version, self.version))
+
+
+class PrecompressedResponses():
+    """
+    Store of precompressed documents, by key
+    """
+
+    def __init__(self, gzip_level=9, brotli_quality=9):
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._documents = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """
+        Get the document stored for key, (re)building it if its version changed
+        :param key: document key
+        :param version: tuple of the objects the document is built from. The stored document is rebuilt when one of
+        them is not the same object as when it was built
+        :param build: function returning the JSON-serializable document
+        :return: PrecompressedDocument
+        """
+        with self._lock:
+            document = self._documents.get(key)
+            if document and document.is_version(version):
+                self.hits += 1
+                return document
+            self.misses += 1
+            # same bytes as jsonify would produce
+            body = current_app.json.response(build()).get_data()
+            document = PrecompressedDocument(version, body, self.gzip_level, self.brotli_quality)
+            self._documents[key] = document
+            return document
+
+    def response(self, document):
+        """
+        Serve a document, in the best encoding accepted by the client, or as a 304 response if the client's
+        If-None-Match matches it
+        :param document: PrecompressedDocument
+        :return: flask Response
+        """
+        accepted = request.accept_encodings
+        encoding = next((e for e in ('br', 'gzip') if e in document.bodies and accepted.quality(e) > 0), 'identity')
+        etag = document.etag if encoding == 'identity' else '{}-{}'.format(document.etag, encoding)
+
+        if document.etag in [tag.split('-', 1)[0] for tag in request.if_none_match.as_set()]:
+            response = Response(status=304)
+        else:
+            response = Response(document.bodies[encoding], mimetype='application/json')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+# stands for the features list while serializing the rest of the feature collection
+_FEATURES_PLACEHOLDER = '__streamed_features__'
+
+
+def _json_dumps_args():
+    """
+    :return: the json.dumps arguments used by jsonify in the current app
+    """
+    provider = current_app.json
+    if (provider.compact is None and current_app.debug) or provider.compact is False:
+        return {'indent': 2}
+    return {'separators': (',', ':')}
+
+
+def _chunked(parts, chunk_size):
+    """
+    Group strings in chunks of about chunk_size characters
+    """
+    chunk, size = [], 0
+    for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def stream_feature_collection(feature_lists, chunk_size=64 * 1024):
+    """
+    Stream a FeatureCollection, list after list, with the same bytes as jsonify would produce for the whole collection
+    :param feature_lists: lists of features (e.g. one per source), concatenated in the collection
+    :param chunk_size: approximate size of the streamed chunks
+    :return: flask Response
+    """
+    dump_args = _json_dumps_args()
+    dumps = functools.partial(current_app.json.dumps, **dump_args)
+    indent = dump_args.get('indent')
+    collection = dumps({
+        'type': 'FeatureCollection',
+        'properties': {},
+        'totalResults': sum(len(features) for features in feature_lists),
+        'features': _FEATURES_PLACEHOLDER,
+    })
+    head, tail = collection.split(dumps(_FEATURES_PLACEHOLDER), 1)
+
+    if indent is None:
+        separator, opening, closing = ',', '[', ']'
+        format_feature = dumps
+    else:
+        # the features are items of a list at depth 1 of the collection
+        item_indent = ' ' * (2 * indent)
+        separator, opening, closing = ',\n', '[\n', '\n' + ' ' * indent + ']'
+
+        def format_feature(feature):
+            return '\n'.join(item_indent + line for line in dumps(feature).split('\n'))
+
+    def generate():
+        yield head
+        first = True
+        for features in feature_lists:
+            for feature in features:
+                yield (opening if first else separator) + format_feature(feature)
+                first = False
+        yield ('[]' if first else closing) + tail + '\n'
+
+    return Response(_chunked(generate(), chunk_size), mimetype=current_app.json.mimetype)
+
+
+def stream_ndjson_features(feature_lists, chunk_size=64 * 1024):
+    """
+    Stream features as newline-delimited GeoJSON: one compact feature per line
+    :param feature_lists: lists of features (e.g. one per source)
+    :param chunk_size: approximate size of the streamed chunks
+    :return: flask Response
+    """
+    dumps = functools.partial(current_app.json.dumps, separators=(',', ':'))
+
+    def generate():
+        for features in feature_lists:
+            for feature in features:
+                yield dumps(feature) + '\n'
+
+    return Response(_chunked(generate(), chunk_size), mimetype='application/x-ndjson')
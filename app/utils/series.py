@@ -0,0 +1,207 @@
+# encoding: utf-8
+"""Operations on the stations series arrays (see parsing.txt2series)
+
+The series are in chronological order: time ranges are selected by binary search over the timestamps row.
+The statistics of the series are computed by prepare_stations.py and stored in the sources statistics files.
+"""
+
+import numpy
+
+from utils import parsing
+from utils.parsing import SERIES_TIME, SERIES_H
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 date or datetime (e.g. 2020-01-31, 2020-01-31T12:30), taken as UTC
+    :param value: string
+    :return: epoch timestamp in seconds, None if the value can't be parsed
+    """
+    try:
+        return float(numpy.datetime64(value.strip().replace(' ', 'T'), 's').astype(numpy.int64))
+    except ValueError:
+        return None
+
+
+def time_range(series, start=None, end=None):
+    """
+    Select the observations between start and end (included)
+    :param series: series array
+    :param start: epoch timestamp in seconds. None for no lower bound
+    :param end: epoch timestamp in seconds. None for no upper bound
+    :return: a view on the selected columns
+    """
+    times = series[SERIES_TIME]
+    lo = 0 if start is None else numpy.searchsorted(times, start, side='left')
+    hi = len(times) if end is None else numpy.searchsorted(times, end, side='right')
+    return series[:, lo:hi]
+
+
+def downsample(series, max_points):
+    """
+    Reduce the series to max_points observations while preserving its shape, using the Largest-Triangle-Three-Buckets
+    algorithm: the first and last observations are kept, and in each bucket of the others, the one forming the largest
+    triangle with the one selected in the previous bucket and the average of the next bucket.
+    The selected observations are returned as is (all rows), not interpolated.
+    :param series: series array
+    :param max_points: max number of observations
+    :return: the series itself if it is small enough, else the selected columns
+    """
+    n = series.shape[1]
+    if max_points is None or n <= max_points:
+        return series
+    if max_points < 3:
+        return series[:, [0, n - 1][:max(max_points, 0)]]
+
+    x = numpy.asarray(series[SERIES_TIME], dtype=numpy.float64)
+    y = numpy.asarray(series[SERIES_H], dtype=numpy.float64)
+    # bucket b covers the observations edges[b]:edges[b + 1], the first and last observations aside
+    edges = numpy.linspace(1, n - 1, max_points - 1).astype(numpy.int64)
+    sums_x = numpy.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = numpy.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    counts = numpy.diff(edges)
+    # average of each bucket, the last observation standing as the bucket following the last one
+    avg_x = numpy.append(sums_x / counts, x[n - 1])
+    avg_y = numpy.append(sums_y / counts, y[n - 1])
+
+    selected = numpy.empty(max_points, dtype=numpy.int64)
+    selected[0] = 0
+    a = 0
+    for b in range(max_points - 2):
+        lo, hi = edges[b], edges[b + 1]
+        areas = numpy.abs((x[a] - avg_x[b + 1]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[b + 1] - y[a]))
+        a = lo + int(numpy.argmax(areas))
+        selected[b + 1] = a
+    selected[-1] = n - 1
+    return series[:, selected]
+
+
+# pre-aggregated series levels: name -> numpy datetime unit of the buckets. The aggregated series arrays rows are
+# indexed by AGGREGATE_* (the bucket start time and the mean height share the raw series rows indexes, so that
+# time_range and downsample apply to them as well)
+AGGREGATION_LEVELS = {'monthly': 'M', 'yearly': 'Y'}
+AGGREGATE_TIME = SERIES_TIME
+AGGREGATE_MEAN = SERIES_H
+AGGREGATE_MIN = 2
+AGGREGATE_MAX = 3
+AGGREGATE_COUNT = 4
+
+
+def aggregate(series, level):
+    """
+    Aggregate a series by time buckets
+    :param series: series array
+    :param level: one of AGGREGATION_LEVELS
+    :return: float64 array of shape (5, number of non-empty buckets), rows indexed by AGGREGATE_* (bucket start time,
+    mean, min and max heights, number of observations)
+    """
+    unit = AGGREGATION_LEVELS[level]
+    buckets = series[SERIES_TIME].astype(numpy.int64).astype('datetime64[s]').astype('datetime64[{}]'.format(unit))
+    # the series is sorted: each bucket is a contiguous range
+    keys, starts, counts = numpy.unique(buckets, return_index=True, return_counts=True)
+    result = numpy.empty((5, len(keys)), dtype=numpy.float64)
+    if len(keys):
+        h = numpy.asarray(series[SERIES_H], dtype=numpy.float64)
+        result[AGGREGATE_TIME] = keys.astype('datetime64[s]').astype(numpy.int64)
+        result[AGGREGATE_MEAN] = numpy.add.reduceat(h, starts) / counts
+        result[AGGREGATE_MIN] = numpy.minimum.reduceat(h, starts)
+        result[AGGREGATE_MAX] = numpy.maximum.reduceat(h, starts)
+        result[AGGREGATE_COUNT] = counts
+    return result
+
+
+def bucket_start(timestamp, level):
+    """
+    :param timestamp: epoch timestamp in seconds
+    :param level: one of AGGREGATION_LEVELS
+    :return: start of the bucket containing the timestamp, as an epoch timestamp in seconds
+    """
+    bucket = numpy.datetime64(int(timestamp), 's').astype('datetime64[{}]'.format(AGGREGATION_LEVELS[level]))
+    return int(bucket.astype('datetime64[s]').astype(numpy.int64))
+
+
+def aggregate2data_vectors(aggregated):
+    """
+    Convert an aggregated series to the data vectors served by the API
+    :param aggregated: aggregated series array
+    :return: {'dates': [...], 'h': [...], 'h_min': [...], 'h_max': [...], 'count': [...]}, h being the mean height
+    """
+    data = parsing.series2data_vectors(aggregated)
+    data['h_min'] = aggregated[AGGREGATE_MIN].tolist()
+    data['h_max'] = aggregated[AGGREGATE_MAX].tolist()
+    data['count'] = aggregated[AGGREGATE_COUNT].astype(numpy.int64).tolist()
+    return data
+
+
+SECONDS_PER_YEAR = 365.2425 * 86400
+# percentiles of the monthly climatology
+CLIMATOLOGY_PERCENTILES = [10, 50, 90]
+
+
+def _observation(series, i):
+    return {
+        'date': parsing._format_timestamps(series[SERIES_TIME, i:i + 1])[0],
+        'h': float(series[SERIES_H, i]),
+    }
+
+
+def climatology(series):
+    """
+    Monthly distribution of the water height
+    :param series: series array
+    :return: {'count': [...], 'p10': [...], 'p50': [...], 'p90': [...]} dict of 12 values lists, one per month
+    (January first). The percentiles are None for the months without observations
+    """
+    months = series[SERIES_TIME].astype('datetime64[s]').astype('datetime64[M]').astype(numpy.int64) % 12
+    h = series[SERIES_H]
+    result = {'count': numpy.bincount(months, minlength=12).tolist()}
+    for p in CLIMATOLOGY_PERCENTILES:
+        result['p{}'.format(p)] = [None] * 12
+    for month in numpy.unique(months):
+        values = numpy.percentile(h[months == month], CLIMATOLOGY_PERCENTILES)
+        for p, value in zip(CLIMATOLOGY_PERCENTILES, values):
+            result['p{}'.format(p)][month] = float(value)
+    return result
+
+
+def statistics(series):
+    """
+    Aggregates of a station's series
+    :param series: series array
+    :return: dict with the number of observations, first and latest observations, min, max (observations), mean,
+    standard deviation, trend (linear regression slope, in height unit per year), monthly climatology (see
+    climatology) and the anomaly of the latest observation (its difference with the median of its month)
+    """
+    n = series.shape[1]
+    if not n:
+        return {'count': 0}
+    h = series[SERIES_H]
+    times = series[SERIES_TIME]
+    stats = {
+        'count': n,
+        'first': _observation(series, 0),
+        'latest': _observation(series, n - 1),
+        'min': _observation(series, int(numpy.argmin(h))),
+        'max': _observation(series, int(numpy.argmax(h))),
+        'mean': float(h.mean()),
+        'std': float(h.std()),
+        'trend': None,
+        'climatology': climatology(series),
+    }
+    if n > 1 and times[-1] > times[0]:
+        stats['trend'] = float(numpy.polyfit((times - times[0]) / SECONDS_PER_YEAR, h, 1)[0])
+    latest_month = int(numpy.datetime64(int(times[-1]), 's').astype('datetime64[M]').astype(numpy.int64) % 12)
+    median = stats['climatology']['p50'][latest_month]
+    stats['anomaly'] = stats['latest']['h'] - median if median is not None else None
+    return stats
+
+
+def latest(stats):
+    """
+    Extract the latest observation and its anomaly from a station's statistics
+    :param stats: dict returned by statistics
+    :return: {'date': ..., 'h': ..., 'anomaly': ...}, None if the station has no observation
+    """
+    if not stats.get('count'):
+        return None
+    return dict(stats['latest'], anomaly=stats['anomaly'])
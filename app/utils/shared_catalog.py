@@ -0,0 +1,176 @@
+# encoding: utf-8
+"""Merged stations list stored as a single binary file, memory-mapped read-only by the API processes
+
+The file is written by prepare_stations.py. The API processes map it instead of parsing a JSON stations list: its pages
+live in the OS page cache, shared by all the uwsgi workers, instead of being copied as Python objects in every worker.
+The features are stored as compact JSON documents and decoded on access.
+
+Layout: 8 bytes magic, header length (uint64, little-endian), JSON header (number of features, source ids, and the
+position, dtype and shape of every array), then the arrays, 64 bytes aligned:
+ * offsets: start of every feature in the features array (n + 1 values)
+ * sources: position of every feature's source in the header's source ids
+ * coordinates: (n, 2) longitude, latitude array
+ * ids / id_positions: sorted station ids and the position of their first feature
+ * features: the features documents, concatenated
+"""
+
+import json
+import mmap
+import struct
+from collections.abc import Sequence
+
+import numpy
+
+from utils import spatial
+
+MAGIC = b'BNCAT01\n'
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_catalog(file, features, sources):
+    """
+    Write a merged stations list
+    :param file: binary file object
+    :param features: stations features
+    :param sources: source id of every feature
+    :return:
+    """
+    documents = [json.dumps(f, separators=(',', ':'), default=str).encode() for f in features]
+    offsets = numpy.zeros(len(documents) + 1, dtype='<i8')
+    offsets[1:] = numpy.cumsum([len(d) for d in documents])
+    source_ids = list(dict.fromkeys(sources))
+    positions = {source_id: i for i, source_id in enumerate(source_ids)}
+    coordinates = numpy.array([f['geometry']['coordinates'][:2] for f in features], dtype='<f8').reshape(-1, 2)
+
+    # first feature of every station id
+    first = {}
+    for position, f in enumerate(features):
+        first.setdefault(str(f['properties']['productIdentifier']).encode(), position)
+    ids = numpy.array(list(first), dtype='S{}'.format(max([len(k) for k in first] + [1])))
+    order = numpy.argsort(ids, kind='stable')
+
+    arrays = {
+        'offsets': offsets,
+        'sources': numpy.array([positions[s] for s in sources], dtype='<i4'),
+        'coordinates': coordinates,
+        'ids': ids[order],
+        'id_positions': numpy.array(list(first.values()), dtype='<i8')[order],
+        'features': numpy.frombuffer(b''.join(documents), dtype=numpy.uint8),
+    }
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'count': len(features), 'sources': source_ids, 'arrays': layout}).encode()
+
+    file.write(MAGIC)
+    file.write(struct.pack('<Q', len(header)))
+    file.write(header)
+    start = _align(len(MAGIC) + 8 + len(header))
+    file.write(b'\0' * (start - len(MAGIC) - 8 - len(header)))
+    for name, array in arrays.items():
+        file.write(b'\0' * (start + layout[name][0] - file.tell()))
+        file.write(array.tobytes())
+
+
+class FeatureSequence(Sequence):
+    """
+    Read-only sequence of the features of a SharedCatalog, decoded on access: every access returns a new object
+    """
+
+    def __init__(self, buffer, start, offsets):
+        self._buffer = buffer
+        self._start = start
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _decode(self, begin, end):
+        return json.loads(self._buffer[self._start + begin:self._start + end])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('feature index out of range')
+        return self._decode(int(self._offsets[i]), int(self._offsets[i + 1]))
+
+    def __iter__(self):
+        offsets = self._offsets.tolist()
+        for begin, end in zip(offsets, offsets[1:]):
+            yield self._decode(begin, end)
+
+
+class SharedCatalog():
+    """
+    Memory-mapped merged stations list (see write_catalog), with its indexes: the source id of every feature, a
+    productIdentifier -> position index, and a spatial index built on the stored coordinates
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            # the mapping outlives the file object, and the file itself if it is replaced
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a stations catalog file'.format(filename))
+        header_length, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        header = json.loads(self._mmap[len(MAGIC) + 8:len(MAGIC) + 8 + header_length])
+        start = _align(len(MAGIC) + 8 + header_length)
+        arrays = {}
+        for name, (offset, dtype, shape) in header['arrays'].items():
+            arrays[name] = numpy.frombuffer(self._mmap, dtype=dtype, count=int(numpy.prod(shape)),
+                                            offset=start + offset).reshape(shape)
+
+        self.source_ids = header['sources']
+        self.coordinates = arrays['coordinates']
+        self._sources = arrays['sources']
+        self._ids = arrays['ids']
+        self._id_positions = arrays['id_positions']
+        self.features = FeatureSequence(self._mmap, start + header['arrays']['features'][0], arrays['offsets'])
+        self.spatial_index = spatial.SpatialIndex(self.coordinates[:, 0], self.coordinates[:, 1])
+        # stations list view of the catalog. Its features are decoded on access
+        self.catalog = {
+            'type': 'FeatureCollection',
+            'properties': {},
+            'totalResults': len(self.features),
+            'features': self.features,
+        }
+
+    def __len__(self):
+        return len(self.features)
+
+    def source(self, position):
+        """
+        :param position: feature position
+        :return: the feature's source id
+        """
+        return self.source_ids[self._sources[position]]
+
+    def position(self, station_id):
+        """
+        :param station_id: the id given in productIdentifier field
+        :return: position of the station's first feature, None if not found
+        """
+        key = str(station_id).encode()
+        i = int(numpy.searchsorted(self._ids, key))
+        if i < len(self._ids) and self._ids[i] == key:
+            return int(self._id_positions[i])
+        return None
+
+    def find(self, station_id):
+        """
+        :param station_id: the id given in productIdentifier field
+        :return: (source_id, feature) tuple, None if not found
+        """
+        position = self.position(station_id)
+        if position is None:
+            return None
+        return self.source(position), self.features[position]
@@ -0,0 +1,124 @@
+# encoding: utf-8
+"""Lightweight thumbnails: the water height series drawn as a sparkline
+
+An alternative to the matplotlib thumbnails (see thumbnails.py): the series is downsampled to two points per pixel
+column and drawn as a single polyline, written either as SVG or as a small palette PNG rasterized with NumPy and encoded
+with zlib. No figure, axes or text layout involved.
+"""
+
+import struct
+import zlib
+
+import numpy
+
+from utils import io_utils, parsing, series as series_utils
+
+SPARKLINE_SIZE = (300, 200)
+SPARKLINE_COLOR = (0, 0, 255)
+# blank space around the line, in pixels
+SPARKLINE_MARGIN = 4
+
+
+def _polyline(series, width, height):
+    """
+    Downsample a series and scale it to the image
+    :return: (x, y) pixel coordinates arrays (y pointing down)
+    """
+    series = series_utils.downsample(series, 2 * width)
+    x = numpy.asarray(series[parsing.SERIES_TIME], dtype=numpy.float64)
+    y = numpy.asarray(series[parsing.SERIES_H], dtype=numpy.float64)
+    if not len(x):
+        return x, y
+
+    def scale(values, size):
+        lo, hi = values.min(), values.max()
+        span = hi - lo if hi > lo else 1.0
+        return SPARKLINE_MARGIN + (values - lo) / span * (size - 1 - 2 * SPARKLINE_MARGIN)
+
+    x = scale(x, width)
+    y = (height - 1) - scale(y, height)
+    if x.max() == x.min():
+        x = numpy.full(len(x), (width - 1) / 2)
+    return x, y
+
+
+def render_svg(series, width=SPARKLINE_SIZE[0], height=SPARKLINE_SIZE[1], color=SPARKLINE_COLOR):
+    """
+    Draw a series as an SVG sparkline
+    :param series: series array (see parsing.txt2series)
+    :param width: width, in pixels
+    :param height: height, in pixels
+    :param color: RGB line color
+    :return: SVG document bytes
+    """
+    x, y = _polyline(series, width, height)
+    points = ' '.join('{:.1f},{:.1f}'.format(px, py) for px, py in zip(x, y))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 {w} {h}">'
+            '<polyline fill="none" stroke="#{c}" stroke-width="1" stroke-linejoin="round" points="{p}"/>'
+            '</svg>').format(w=width, h=height, c=''.join('{:02x}'.format(v) for v in color), p=points).encode()
+
+
+def _rasterize(x, y, width, height):
+    """
+    Draw the polyline on a (height, width) boolean image, sampling each segment at least once per pixel
+    """
+    image = numpy.zeros((height, width), dtype=bool)
+    if len(x) == 1:
+        image[int(round(y[0])), int(round(x[0]))] = True
+    elif len(x) > 1:
+        steps = numpy.maximum(numpy.ceil(numpy.maximum(numpy.abs(numpy.diff(x)), numpy.abs(numpy.diff(y)))), 1)
+        steps = steps.astype(numpy.int64)
+        # position of every sample along its segment
+        segment = numpy.repeat(numpy.arange(len(steps)), steps)
+        t = (numpy.arange(steps.sum()) - numpy.repeat(numpy.cumsum(steps) - steps, steps)) / steps[segment]
+        px = numpy.append(x[segment] + t * (x[segment + 1] - x[segment]), x[-1])
+        py = numpy.append(y[segment] + t * (y[segment + 1] - y[segment]), y[-1])
+        image[numpy.rint(py).astype(numpy.int64), numpy.rint(px).astype(numpy.int64)] = True
+    return image
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def render_png(series, width=SPARKLINE_SIZE[0], height=SPARKLINE_SIZE[1], color=SPARKLINE_COLOR):
+    """
+    Draw a series as a PNG sparkline: 1-bit palette image, transparent background
+    :param series: series array (see parsing.txt2series)
+    :param width: width, in pixels
+    :param height: height, in pixels
+    :param color: RGB line color
+    :return: PNG image bytes
+    """
+    x, y = _polyline(series, width, height)
+    image = _rasterize(x, y, width, height)
+    # one filter byte (0: none) before each row of packed bits
+    rows = numpy.packbits(image, axis=1)
+    raw = numpy.hstack([numpy.zeros((height, 1), dtype=numpy.uint8), rows]).tobytes()
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 1, 3, 0, 0, 0)),
+        _png_chunk(b'PLTE', bytes((255, 255, 255) + tuple(color))),
+        _png_chunk(b'tRNS', b'\x00'),
+        _png_chunk(b'IDAT', zlib.compress(raw, 9)),
+        _png_chunk(b'IEND', b''),
+    ])
+
+
+def render_station(data_file, series_file, out_file):
+    """
+    Render a station's sparkline, as SVG or PNG according to the output file extension. Same signature as
+    thumbnails.render_station, so that both engines run in the same rendering pool
+    :param data_file: TXT data file path
+    :param series_file: binary series file path, used instead of the data file if it is up to date
+    :param out_file: output file path
+    :return: None on success, else the error message
+    """
+    try:
+        series = io_utils.load_series(series_file, data_file)
+        image = render_svg(series) if out_file.endswith('.svg') else render_png(series)
+        with io_utils.atomic_open(out_file, 'wb') as outfile:
+            outfile.write(image)
+    except (ValueError, IndexError, parsing.HydrowebParsingError) as e:
+        return str(e)
+    return None
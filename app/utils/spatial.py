@@ -0,0 +1,140 @@
+# encoding: utf-8
+"""Spatial index over the stations coordinates
+
+The stations are indexed in a KD-tree built on their 3D unit-sphere vectors: the chord distance between two such
+vectors is monotonic with the great-circle distance, so the tree answers exact nearest-neighbours and radius queries.
+"""
+
+import heapq
+import numpy
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great-circle distance, in km. Works on scalars as well as on numpy arrays
+    :return: distance(s) in km
+    """
+    lon1, lat1, lon2, lat2 = map(numpy.radians, (lon1, lat1, lon2, lat2))
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+
+def _to_xyz(lon, lat):
+    lon, lat = numpy.radians(lon), numpy.radians(lat)
+    return numpy.stack([numpy.cos(lat) * numpy.cos(lon), numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)], axis=-1)
+
+
+class SpatialIndex():
+    """
+    KD-tree over points given as lon/lat coordinates (degrees).
+    The points are stored reordered, so that every tree node covers a contiguous range of them.
+    """
+
+    def __init__(self, lon, lat, leaf_size=16):
+        self.lon = numpy.asarray(lon, dtype=numpy.float64).reshape(-1)
+        self.lat = numpy.asarray(lat, dtype=numpy.float64).reshape(-1)
+        self.leaf_size = leaf_size
+        self._perm = numpy.arange(len(self.lon))
+        xyz = _to_xyz(self.lon, self.lat).reshape(-1, 3)
+        self._tree = self._build(xyz, 0, len(self._perm)) if len(self._perm) else None
+        self._xyz = xyz[self._perm]
+
+    def __len__(self):
+        return len(self.lon)
+
+    def _build(self, xyz, lo, hi):
+        """
+        Recursively build the node covering self._perm[lo:hi]
+        :return: leaf node (lo, hi) or inner node (lo, hi, axis, split, left, right)
+        """
+        if hi - lo <= self.leaf_size:
+            return (lo, hi)
+        pts = xyz[self._perm[lo:hi]]
+        axis = int(numpy.argmax(pts.max(axis=0) - pts.min(axis=0)))
+        mid = (hi - lo) // 2
+        order = numpy.argpartition(pts[:, axis], mid)
+        self._perm[lo:hi] = self._perm[lo:hi][order]
+        split = xyz[self._perm[lo + mid], axis]
+        return (lo, hi, axis, split,
+                self._build(xyz, lo, lo + mid),
+                self._build(xyz, lo + mid, hi))
+
+    def nearest(self, lon, lat, k, exclude=None):
+        """
+        k nearest neighbours of a point
+        :param lon:
+        :param lat:
+        :param k: number of neighbours
+        :param exclude: optional predicate on the point's index. Matching points are skipped
+        :return: (indices, distances in km) arrays, by order of distance
+        """
+        if self._tree is None or k <= 0:
+            return self._result([])
+        q = _to_xyz(lon, lat)
+        heap = []  # max-heap on the squared chord distance: (-d2, index)
+        stack = [(0.0, self._tree)]
+        while stack:
+            bound, node = stack.pop()
+            if len(heap) == k and bound >= -heap[0][0]:
+                continue
+            if len(node) == 2:
+                lo, hi = node
+                d2 = ((self._xyz[lo:hi] - q) ** 2).sum(axis=1)
+                for i in numpy.argsort(d2):
+                    idx = int(self._perm[lo + i])
+                    if exclude is not None and exclude(idx):
+                        continue
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d2[i], idx))
+                    elif d2[i] < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d2[i], idx))
+                    else:
+                        break
+                continue
+            lo, hi, axis, split, left, right = node
+            diff = q[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            # push the far side first, so that the near side is explored first
+            stack.append((max(bound, diff * diff), far))
+            stack.append((bound, near))
+        return self._result([idx for _, idx in sorted(heap, reverse=True)], lon, lat)
+
+    def within(self, lon, lat, radius):
+        """
+        Points closer than radius to the given point
+        :param lon:
+        :param lat:
+        :param radius: radius, in km
+        :return: (indices, distances in km) arrays, by order of distance
+        """
+        if self._tree is None:
+            return self._result([])
+        q = _to_xyz(lon, lat)
+        chord = 2 * numpy.sin(min(radius / EARTH_RADIUS_KM, numpy.pi) / 2)
+        r2 = chord * chord
+        found = []
+        stack = [self._tree]
+        while stack:
+            node = stack.pop()
+            if len(node) == 2:
+                lo, hi = node
+                d2 = ((self._xyz[lo:hi] - q) ** 2).sum(axis=1)
+                found.extend(self._perm[lo:hi][d2 <= r2])
+                continue
+            lo, hi, axis, split, left, right = node
+            diff = q[axis] - split
+            if diff < 0 or diff * diff <= r2:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= r2:
+                stack.append(right)
+        indices, distances = self._result(found, lon, lat)
+        order = numpy.argsort(distances, kind='stable')
+        return indices[order], distances[order]
+
+    def _result(self, indices, lon=None, lat=None):
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        if not len(indices):
+            return indices, numpy.zeros(0)
+        return indices, haversine(lon, lat, self.lon[indices], self.lat[indices])
@@ -0,0 +1,198 @@
+# encoding: utf-8
+"""Cache of the thumbnails rendered on demand by the API
+
+Rendered images are kept in a size-bounded disk cache (shared by the uwsgi processes, least recently used files evicted
+first) and in a per-process in-memory LRU. Concurrent requests for the same image, in a process, wait for a single
+render.
+"""
+
+import glob
+import os
+import threading
+from collections import OrderedDict
+from os import path
+
+from utils.io_utils import atomic_open
+
+
+class ThumbnailCache():
+    """
+    Images cache, by key and version: an image is rendered again when its version (e.g. the signature of the station's
+    data file) changes
+    """
+
+    def __init__(self, folder, max_bytes=256 * 1024 * 1024, memory_max_bytes=32 * 1024 * 1024):
+        """
+        :param folder: disk cache folder
+        :param max_bytes: max cumulated size of the disk cache files
+        :param memory_max_bytes: max cumulated size of the images kept in memory
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # cumulated size of the disk cache files, computed on first write
+        self._disk_bytes = None
+        self._rendering = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _filename(self, key, version):
+        return path.join(self.folder, '{}-{}.png'.format(key, version))
+
+    def get(self, key, version, render):
+        """
+        Get an image, from memory, from disk, or rendered
+        :param key: image key, usable as a relative file path (e.g. source_id/station_id-300x200-100)
+        :param version: image version, usable in a file name
+        :param render: function returning the image bytes
+        :return: image bytes
+        """
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached and cached[0] == version:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            pending = self._rendering.get(key)
+            if pending is None or pending[0] != version:
+                pending = (version, threading.Event(), {})
+                self._rendering[key] = pending
+                owner = True
+            else:
+                owner = False
+
+        version, done, result = pending
+        if not owner:
+            # coalesce with the render in progress
+            done.wait()
+            if 'image' in result:
+                with self._lock:
+                    self.hits += 1
+                return result['image']
+            return self.get(key, version, render)
+
+        try:
+            image = self._read(key, version)
+            rendered = image is None
+            if rendered:
+                image = render()
+                self._write(key, version, image)
+            with self._lock:
+                if rendered:
+                    self.misses += 1
+                else:
+                    self.disk_hits += 1
+            result['image'] = image
+            self._remember(key, version, image)
+            return image
+        finally:
+            with self._lock:
+                if self._rendering.get(key) is pending:
+                    del self._rendering[key]
+            done.set()
+
+    def _remember(self, key, version, image):
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous:
+                self._memory_bytes -= len(previous[1])
+            if len(image) > self.memory_max_bytes:
+                return
+            self._memory[key] = (version, image)
+            self._memory_bytes += len(image)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _read(self, key, version):
+        filename = self._filename(key, version)
+        try:
+            with open(filename, 'rb') as file:
+                image = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # the access time orders the eviction
+            os.utime(filename)
+        except OSError:
+            pass
+        return image
+
+    def _write(self, key, version, image):
+        filename = self._filename(key, version)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        # older versions of the image
+        for stale in glob.glob(glob.escape(self._filename(key, '')[:-len('.png')]) + '*.png'):
+            self._remove(stale)
+        with atomic_open(filename, 'wb') as file:
+            file.write(image)
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(image)
+        if self._disk_usage() > self.max_bytes:
+            self._evict()
+
+    def _remove(self, filename):
+        try:
+            size = os.stat(filename).st_size
+            os.remove(filename)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+
+    def _files(self):
+        files = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                try:
+                    st = os.stat(path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path.join(root, name)))
+        return files
+
+    def _disk_usage(self):
+        with self._lock:
+            if self._disk_bytes is not None:
+                return self._disk_bytes
+        usage = sum(size for _, size, _ in self._files())
+        with self._lock:
+            self._disk_bytes = usage
+        return usage
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the disk cache is back under 90% of its max size. The size is
+        measured again, since the other processes write to the same folder
+        """
+        files = sorted(self._files())
+        usage = sum(size for _, size, _ in files)
+        for _, size, filename in files:
+            if usage <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            usage -= size
+        with self._lock:
+            self._disk_bytes = usage
+
+    def stats(self):
+        """
+        :return: dict of the cache counters
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+            }
@@ -0,0 +1,111 @@
+# encoding: utf-8
+"""Rendering of the stations graph thumbnails
+
+Uses matplotlib's object-oriented API on an Agg canvas (no pyplot, no interactive backend). A renderer keeps a single
+figure, reused for every thumbnail it draws.
+"""
+
+import io
+import threading
+
+import matplotlib
+import numpy
+from matplotlib import dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from utils import io_utils, parsing
+
+THUMBNAIL_RC = {
+    'font.size': 6.0,
+    'figure.frameon': False,
+}
+THUMBNAIL_FIGSIZE = (3, 2)
+
+
+class ThumbnailRenderer():
+    """
+    Draws a station's water height series as a small graph
+    """
+
+    def __init__(self, figsize=THUMBNAIL_FIGSIZE, dpi=None):
+        with matplotlib.rc_context(THUMBNAIL_RC):
+            self.figure = Figure(figsize=figsize, dpi=dpi)
+            self.canvas = FigureCanvasAgg(self.figure)
+            self.ax = self.figure.add_subplot(111)
+
+    def render(self, series, file, format='png'):
+        """
+        Render a series
+        :param series: series array (see parsing.txt2series)
+        :param file: file path or file object to write the image to
+        :param format: image format
+        :return:
+        """
+        with matplotlib.rc_context(THUMBNAIL_RC):
+            ax = self.ax
+            ax.clear()
+            #ax.xaxis.set_minor_locator(mdates.MonthLocator())
+            ax.xaxis.set_major_locator(mdates.YearLocator())
+            ax.spines['top'].set_visible(False)
+            ax.spines['right'].set_visible(False)
+            ax.spines['bottom'].set_visible(True)
+            ax.spines['left'].set_visible(True)
+            ax.plot(numpy.asarray(series[parsing.SERIES_TIME]).astype(numpy.int64).astype('datetime64[s]'),
+                    numpy.asarray(series[parsing.SERIES_H], numpy.float32), 'b-', linewidth=0.5)
+            self.figure.savefig(file, format=format)
+
+
+# Renderer of the current worker process
+_renderer = None
+# Renderers of the thumbnails rendered on demand, by (figsize, dpi), and lock serializing their use (matplotlib figures
+# and rc context are not thread-safe)
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def init_worker():
+    """
+    Initializer of the rendering worker processes
+    """
+    global _renderer
+    _renderer = ThumbnailRenderer()
+
+
+def render_station(data_file, series_file, png_file):
+    """
+    Render a station's thumbnail. Runs in a rendering worker process, or in the current process if init_worker was
+    called in it
+    :param data_file: TXT data file path
+    :param series_file: binary series file path, used instead of the data file if it is up to date
+    :param png_file: output file path
+    :return: None on success, else the error message
+    """
+    try:
+        series = io_utils.load_series(series_file, data_file)
+        with io_utils.atomic_open(png_file, 'wb') as outfile:
+            _renderer.render(series, outfile)
+    except (ValueError, IndexError, parsing.HydrowebParsingError) as e:
+        return str(e)
+    return None
+
+
+def render_png(series, width, height, dpi):
+    """
+    Render a thumbnail in memory. Thread-safe
+    :param series: series array
+    :param width: width, in pixels
+    :param height: height, in pixels
+    :param dpi: resolution (scales the fonts and lines)
+    :return: PNG image bytes
+    """
+    figsize = (width / dpi, height / dpi)
+    buffer = io.BytesIO()
+    with _renderers_lock:
+        renderer = _renderers.get((figsize, dpi))
+        if renderer is None:
+            if len(_renderers) >= 8:
+                _renderers.clear()
+            renderer = _renderers[(figsize, dpi)] = ThumbnailRenderer(figsize, dpi)
+        renderer.render(series, buffer)
+    return buffer.getvalue()
@@ -1,20 +1,83 @@
 # encoding: utf-8
 
-import requests
 import json
-import random
-import math
-import operator
+import logging
+import tempfile
+import time
+from os import path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import utils.parsing as parsing
+import utils.series as series_utils
+from utils.filtering import FILTER_ATTRIBUTES
+from utils.metrics import metrics
+from utils.responses import PrecompressedResponses, stream_feature_collection, stream_ndjson_features
+from utils.thumbnail_cache import ThumbnailCache
 
-from flask import Flask, abort, request, jsonify, current_app
+from flask import Flask, Response, abort, request, jsonify, current_app, g
 from flask_cors import CORS
 
 from app import app, sources, io_helper
 
+logger = logging.getLogger(__name__)
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 # TODO: pip install flask_cors
+precompressed = PrecompressedResponses(int(app.config['PRECOMPRESS_GZIP_LEVEL']),
+                                       int(app.config['PRECOMPRESS_BROTLI_QUALITY']))
+# the value may come from an environment variable
+stream_stations_list = str(app.config['STREAM_STATIONS_LIST']).lower() in ('true', '1', 'yes')
+thumbnail_cache = ThumbnailCache(app.config['THUMBNAIL_CACHE_PATH'] or io_helper.paths['thumbnails.cache'],
+                                 int(app.config['THUMBNAIL_CACHE_MAX_BYTES']),
+                                 int(app.config['THUMBNAIL_MEMORY_CACHE_MAX_BYTES']))
+# loads the series of the batch station data requests
+series_executor = ThreadPoolExecutor(max_workers=int(app.config['BATCH_DATA_WORKERS']))
+metrics.configure(app.config['METRICS_PATH'] or path.join(tempfile.gettempdir(), 'bn-backend-metrics'),
+                  float(app.config['METRICS_FLUSH_INTERVAL']))
+
+
+def _cache_counters():
+    """
+    :return: the lookups counters of the process' caches, for the metrics
+    """
+    catalog = io_helper.catalog_cache.stats()
+    thumbnails = thumbnail_cache.stats()
+    name = 'bn_cache_requests_total'
+    return [
+        (name, {'cache': 'catalog', 'result': 'hit'}, catalog['hits']),
+        (name, {'cache': 'catalog', 'result': 'miss'}, catalog['misses']),
+        (name, {'cache': 'catalog', 'result': 'reload'}, catalog['reloads']),
+        (name, {'cache': 'precompressed', 'result': 'hit'}, precompressed.hits),
+        (name, {'cache': 'precompressed', 'result': 'miss'}, precompressed.misses),
+        (name, {'cache': 'thumbnails', 'result': 'hit'}, thumbnails['hits']),
+        (name, {'cache': 'thumbnails', 'result': 'disk_hit'}, thumbnails['disk_hits']),
+        (name, {'cache': 'thumbnails', 'result': 'miss'}, thumbnails['misses']),
+    ]
+
+
+metrics.register_collector(_cache_counters)
+
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    """
+    Record the request's latency and response size, by endpoint. Streamed responses are timed until their first byte,
+    and their size is unknown
+    """
+    start = g.pop('request_start', None)
+    if start is not None:
+        # the route pattern, not the path: bounded number of label values
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'endpoint': endpoint, 'method': request.method, 'status': response.status_code}
+        metrics.observe('bn_http_request_duration_seconds', time.perf_counter() - start, **labels)
+        if response.content_length is not None:
+            metrics.observe('bn_http_response_size_bytes', response.content_length, **labels)
+        metrics.maybe_flush()
+    return response
 
 
 @app.route('/')
@@ -22,21 +85,44 @@ def index():
     return ''
 
 
+@app.route('/metrics')
+def get_metrics():
+    """
+    Metrics of all the API processes, in the Prometheus text format
+    :return:
+    """
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
 
 @app.route('/api/v1/stations')
 def list_all_stations():
     """
     Concatenates the list of stations from all sources and return it as geojson
+    The response is serialized and compressed once, until the stations lists change, unless STREAM_STATIONS_LIST is
+    set: it is then streamed, source by source. ?format=ndjson streams it as newline-delimited GeoJSON.
+    Supports the filtering and pagination parameters (see _filter_stations)
     :return:
     """
-    features = _all_stations_as_list()
-    l = {
-        'type': 'FeatureCollection',
-        'properties': {},
-        'totalResults': len(features),
-        'features': features
-    }
-    return jsonify(l)
+    if _is_filtered():
+        return _filter_stations(io_helper.stations_filter(sources))
+    merged = io_helper.merged_catalog()
+    if request.args.get('format') == 'ndjson' or stream_stations_list:
+        if merged:
+            feature_lists = [merged.features]
+        else:
+            feature_lists = [c['features'] for c in io_helper.catalogs(sources).values()]
+        if request.args.get('format') == 'ndjson':
+            return stream_ndjson_features(feature_lists)
+        return stream_feature_collection(feature_lists)
+    if merged:
+        # produced by prepare_stations.py
+        document = precompressed.get('stations', (merged,), lambda: _as_feature_collection(list(merged.features)))
+    else:
+        catalogs = io_helper.catalogs(sources)
+        document = precompressed.get('stations', tuple(catalogs.values()),
+                                     lambda: _as_feature_collection([f for c in catalogs.values() for f in c['features']]))
+    return precompressed.response(document)
 
 
 @app.route('/api/v1/sources')
@@ -64,11 +150,77 @@ def list_stations(source_id):
     """
     Get stations for given data source id
     :param source_id:
-    :return: list of station objects
+    :return: list of station objects. ?format=ndjson streams them as newline-delimited GeoJSON.
+    Supports the filtering and pagination parameters (see _filter_stations)
     """
     src = sources[source_id]
+    if _is_filtered():
+        return _filter_stations(io_helper.stations_filter(sources, source_id))
     json_content = io_helper.resource_get(src, 'list')
+    if request.args.get('format') == 'ndjson':
+        return stream_ndjson_features([json_content['features']])
     #json_content['properties']['source_name'] = src['name']
+    document = precompressed.get('stations/{}'.format(source_id), (json_content,), lambda: json_content)
+    return precompressed.response(document)
+
+
+# stations lists filtering and pagination parameters
+FILTER_PARAMETERS = ['bbox', 'start', 'end', 'limit', 'offset'] + FILTER_ATTRIBUTES
+
+
+def _is_filtered():
+    return any(request.args.get(p) for p in FILTER_PARAMETERS)
+
+
+def _filter_stations(features_filter):
+    """
+    Filter and paginate a stations list, according to the request parameters:
+     - bbox=min_lon,min_lat,max_lon,max_lat
+     - river, basin, lake, status, type, country: comma-separated accepted values (case-insensitive)
+     - start, end: ISO 8601 dates. Keeps the stations whose observation period overlaps them
+     - limit, offset: pagination
+    Unparsable values are ignored
+    :param features_filter: filtering.FeaturesFilter of the stations list
+    :return: flask response. totalResults gives the number of matching stations, properties.startIndex and
+    properties.itemsPerPage describe the returned page
+    """
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            bbox = [float(v) for v in bbox.split(',')]
+        except ValueError:
+            bbox = None
+        if bbox and len(bbox) != 4:
+            bbox = None
+    attributes = {}
+    for attribute in FILTER_ATTRIBUTES:
+        values = request.args.get(attribute)
+        if values:
+            attributes[attribute] = values.split(',')
+    start, end, _ = _series_query()
+    positions = features_filter.query(bbox=bbox or None, attributes=attributes, start=start, end=end)
+
+    offset = request.args.get('offset')
+    try:
+        offset = max(int(offset), 0) if offset else 0
+    except ValueError:
+        offset = 0
+    limit = request.args.get('limit')
+    try:
+        limit = max(int(limit), 0) if limit else None
+    except ValueError:
+        limit = None
+    page = positions[offset:] if limit is None else positions[offset:offset + limit]
+    features = [features_filter.features[i] for i in page]
+
+    if request.args.get('format') == 'ndjson':
+        return stream_ndjson_features([features])
+    json_content = _as_feature_collection(features)
+    json_content['totalResults'] = len(positions)
+    json_content['properties'] = {
+        'startIndex': offset,
+        'itemsPerPage': len(features),
+    }
     return jsonify(json_content)
 
 
@@ -89,13 +241,36 @@ def _get_stations(source_id, station_id):
     Get station definition for given data source id
     :param source_id:
     :param station_id: the id given in productIdentifier field
-    :return: station object. If ?scope=data parameter is provided, returns the stations altimetric data
+    :return: station object. If ?scope=data parameter is provided, returns the stations altimetric data, optionally
+    restricted to the start and end dates and reduced to max_points observations, or at the given resolution (see
+    _get_series_level). If ?scope=statistics parameter is provided, returns the station's statistics. If ?scope=latest
+    parameter is provided, returns its last n observations
     """
     src = sources[source_id]
     scope = request.args.get('scope')
     if scope == 'data':
-        json_content = io_helper.resource_get(src, 'data', station_id)
-        return json_content
+        query = _series_query()
+        resolution = request.args.get('resolution')
+        if resolution not in SERIES_LEVELS:
+            # default behaviour: the raw series
+            series = io_helper.series_get(src, station_id)
+            if series is None:
+                return None
+            return parsing.series2data_vectors(_filter_series(series, query))
+        return _get_series_level(src, station_id, query, resolution)
+    elif scope == 'statistics':
+        return io_helper.station_statistics(src, station_id)
+    elif scope == 'latest':
+        n = int(app.config['DEFAULT_LATEST_LIMIT'])
+        try:
+            n = max(int(request.args.get('n', n)), 0)
+        except ValueError:
+            # we keep default
+            pass
+        series = io_helper.series_tail(src, station_id, n)
+        if series is None:
+            return None
+        return parsing.series2data_vectors(series)
     else:
         # not dealt with => back to default behaviour
         scope = ''
@@ -103,14 +278,228 @@ def _get_stations(source_id, station_id):
         # default behaviour
         json_content = io_helper.resource_get(src, 'list')
         #json_content['properties']['source_name'] = src['name']
-        station_feature = next((d for (index, d) in enumerate(json_content['features']) if d["properties"]["productIdentifier"] == station_id), None)
-        if not station_feature:
+        found = io_helper.station_find(sources, station_id, source_id)
+        if not found:
             return None
-        json_content['features'] = [station_feature]
+        # the list is shared by the catalog cache: work on a copy
+        json_content = dict(json_content)
+        json_content['features'] = [found[1]]
         json_content['totalResults']=1
         return json_content
 
 
+# series resolution levels, from the finest
+SERIES_LEVELS = ['raw'] + list(series_utils.AGGREGATION_LEVELS)
+
+
+def _get_series_level(src, station_id, query, resolution):
+    """
+    Get a station's data at the given resolution level, optionally restricted to the start and end dates and
+    downsampled to max_points
+    :param src: source definition
+    :param station_id: the id given in productIdentifier field
+    :param query: (start, end, max_points) tuple, as returned by _series_query
+    :param resolution: one of SERIES_LEVELS
+    :return: data vectors, with a resolution field. The aggregated levels give the mean height of each period in h,
+    and its min, max and number of observations in h_min, h_max and count: a period is selected if some of it is
+    between the start and end dates. None if the station has no data
+    """
+    start, end, max_points = query
+    series = io_helper.series_level(src, station_id, resolution)
+    if series is None:
+        return None
+    if resolution != 'raw' and start is not None:
+        # the aggregated series are indexed by the start of their periods
+        start = series_utils.bucket_start(start, resolution)
+    series = series_utils.downsample(series_utils.time_range(series, start, end), max_points)
+    if resolution == 'raw':
+        data = parsing.series2data_vectors(series)
+    else:
+        data = series_utils.aggregate2data_vectors(series)
+    data['resolution'] = resolution
+    return data
+
+
+def _series_query():
+    """
+    Read the start, end (ISO 8601 dates or datetimes, UTC) and max_points request parameters
+    :return: (start, end, max_points) tuple, start and end as epoch timestamps. None for the missing or unparsable ones
+    """
+    start = request.args.get('start')
+    start = series_utils.parse_timestamp(start) if start else None
+    end = request.args.get('end')
+    end = series_utils.parse_timestamp(end) if end else None
+    max_points = request.args.get('max_points')
+    try:
+        max_points = max(int(max_points), 0) if max_points else None
+    except ValueError:
+        # we keep the whole series
+        max_points = None
+    return start, end, max_points
+
+
+def _filter_series(series, query):
+    """
+    Apply the start, end and max_points parameters to a series
+    :param series: series array
+    :param query: (start, end, max_points) tuple, as returned by _series_query
+    :return: the selected observations
+    """
+    start, end, max_points = query
+    series = series_utils.time_range(series, start, end)
+    return series_utils.downsample(series, max_points)
+
+
+@app.route('/api/v1/stations/latest')
+def get_latest_observations():
+    """
+    Get the latest observation of every station, with its anomaly (difference with the median of its month), as
+    computed by prepare_stations.py.
+    The response is serialized and compressed once, until the statistics change
+    :return: {"stations": {station_id: {"source": ..., "date": ..., "h": ..., "anomaly": ...}}} JSON object
+    """
+    statistics = {source_id: io_helper.resource_get(src, 'statistics') for source_id, src in sources.items()}
+    statistics = {source_id: stats for source_id, stats in statistics.items() if stats is not None}
+
+    def build():
+        stations = {}
+        for source_id, stats in statistics.items():
+            for station_id, station_stats in stats.items():
+                latest = series_utils.latest(station_stats)
+                if latest is not None and station_id not in stations:
+                    stations[station_id] = dict(latest, source=source_id)
+        return {'stations': stations}
+
+    document = precompressed.get('stations/latest', tuple(statistics.values()), build)
+    return precompressed.response(document)
+
+
+@app.route('/api/v1/stations/data', methods=['GET', 'POST'])
+def get_stations_data():
+    """
+    Get the altimetric data of several stations in one request.
+    The stations are given by the `ids` parameter, comma-separated, or, for POST requests, by a JSON list of ids. Each
+    id may be prefixed by its source id (`source_id:station_id`), else the station is looked up over all sources.
+    Supports the start, end and max_points parameters of ?scope=data.
+    The series are loaded in parallel, and streamed in the order they become ready
+    :return: {"stations": [{"id": ..., "source": ..., "data": ...}, ...]} JSON object. data is null for unknown stations
+    and the ones whose data can't be read
+    """
+    if request.method == 'POST':
+        ids = request.get_json(silent=True)
+        if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+            abort(400)
+    else:
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
+    if len(ids) > int(app.config['BATCH_DATA_MAX_STATIONS']):
+        abort(400)
+
+    query = _series_query()
+    futures = [series_executor.submit(_get_station_data, station, query) for station in dict.fromkeys(ids)]
+
+    def generate():
+        yield '{"stations": ['
+        for i, future in enumerate(as_completed(futures)):
+            yield (', ' if i else '') + json.dumps(future.result())
+        yield ']}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+def _get_station_data(station, query):
+    """
+    Load a station's data, for the batch station data endpoint
+    :param station: station id, optionally prefixed by its source id (source_id:station_id)
+    :param query: (start, end, max_points) tuple, as returned by _series_query
+    :return: {"id": ..., "source": ..., "data": ...} object. data is null if the station is unknown or its data file
+    can't be read: the other stations of the streamed response are still served
+    """
+    source_id, _, station_id = station.rpartition(':')
+    if not source_id:
+        found = io_helper.station_find(sources, station_id)
+        source_id = found[0] if found else None
+    data = None
+    try:
+        series = io_helper.series_get(sources[source_id], station_id) if source_id in sources else None
+        if series is not None:
+            data = parsing.series2data_vectors(_filter_series(series, query))
+    except Exception:
+        logger.exception('failed while loading the data of station {}'.format(station))
+    return {
+        'id': station_id,
+        'source': source_id,
+        'data': data,
+    }
+
+
+@app.route('/api/v1/sources/<source_id>/stations/<station_id>/thumbnail')
+def get_station_thumbnail(source_id, station_id):
+    """
+    Get a station's graph thumbnail, rendered on first request. Supports the width, height (pixels) and dpi parameters
+    :param source_id:
+    :param station_id: the id given in productIdentifier field
+    :return: PNG image
+    """
+    if source_id not in sources:
+        abort(404)
+    return _thumbnail_response(source_id, station_id)
+
+
+@app.route('/api/v1/stations/<station_id>/thumbnail')
+def get_any_station_thumbnail(station_id):
+    """
+    Get a station's graph thumbnail without knowing the source id (see get_station_thumbnail)
+    :param station_id: the id given in productIdentifier field
+    :return: PNG image
+    """
+    found = io_helper.station_find(sources, station_id)
+    if not found:
+        abort(404)
+    return _thumbnail_response(found[0], station_id)
+
+
+# default thumbnail size, in pixels, and resolution: same as the thumbnails rendered by prepare_stations.py
+THUMBNAIL_DEFAULTS = {'width': 300, 'height': 200, 'dpi': 100}
+
+
+def _thumbnail_response(source_id, station_id):
+    """
+    Serve a station's thumbnail from the thumbnails cache, rendering it if needed. The ETag identifies the data file
+    version and the image size: conditional requests are answered without rendering nor reading the image
+    :param source_id:
+    :param station_id:
+    :return: flask Response
+    """
+    src = sources[source_id]
+    params = {}
+    for name, default in THUMBNAIL_DEFAULTS.items():
+        try:
+            params[name] = int(request.args.get(name, default))
+        except ValueError:
+            # we keep default
+            params[name] = default
+    width = min(max(params['width'], 16), int(app.config['THUMBNAIL_MAX_SIZE']))
+    height = min(max(params['height'], 16), int(app.config['THUMBNAIL_MAX_SIZE']))
+    dpi = min(max(params['dpi'], 20), 600)
+
+    version = io_helper.data_signature(src, station_id)
+    if version is None:
+        abort(404)
+    etag = '{}-{}x{}-{}'.format(version, width, height, dpi)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        def render():
+            # imports matplotlib: only done when a thumbnail is rendered
+            from utils import thumbnails
+            return thumbnails.render_png(io_helper.series_get(src, station_id), width, height, dpi)
+
+        key = '{}/{}-{}x{}-{}'.format(source_id, station_id, width, height, dpi)
+        response = Response(thumbnail_cache.get(key, version, render), mimetype='image/png')
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/api/v1/stations/<station_id>')
 def get_any_station(station_id):
     """
@@ -128,18 +517,10 @@ def _get_any_station(station_id):
     :param station_id:
     :return:
     """
-    station = None
-    for src in sources:
-        try:
-            station = _get_stations(src, station_id)
-        except FileNotFoundError as e:
-            # this is not the right source
-            pass
-        else:
-            # If there has been no error, and its value != None this is the right source
-            if station:
-                return station
-    return None
+    found = io_helper.station_find(sources, station_id)
+    if not found:
+        return None
+    return _get_stations(found[0], station_id)
 
 
 @app.route('/api/v1/stations/nearby/<station_id>')
@@ -162,73 +543,52 @@ def get_nearby_stations(station_id):
             nb = int(limit)
         except ValueError:
             # we keep default
-            pass
+            limit = None
 
-    # deactivate radius for now to keep from interferences from Florent's UI
-    # radius = request.args.get('radius')
-    # if radius:
-    #     try:
-    #         radius = float(radius)
-    #     except ValueError:
-    #         # we keep default
-    #         pass
-    #     else:
-    #         nearbys = list(filter(lambda x: x['distance'] < radius, _get_nearby_stations(station_id)))
-    if not nearbys:
+    # radius is expressed in km. When provided, all stations within the radius are returned, unless a limit is given
+    radius = request.args.get('radius')
+    if radius:
+        try:
+            radius = float(radius)
+        except ValueError:
+            # we keep default
+            radius = None
+    if radius:
+        nearbys = _get_nearby_stations(station_id, limit=nb if limit else None, radius=radius)
+    else:
         # default
-        nearbys = _get_nearby_stations(station_id)[:nb]
+        nearbys = _get_nearby_stations(station_id, limit=nb)
+    if nearbys is None:
+        abort(404)
     return jsonify(_as_feature_collection(nearbys))
 
 
+def _get_nearby_stations(station_id, limit=None, radius=None):
+    """
+    Get the stations close to the reference station, using the spatial index
+    :param station_id: the reference station's id
+    :param limit: max number of stations
+    :param radius: max distance, in km
+    :return: list of stations, by order of distance, with their great-circle distance (km) to the reference station.
+    None if the reference station is unknown
+    """
+    found = io_helper.station_find(sources, station_id)
+    if not found:
+        return None
+    ref_station = found[1]
+    lon, lat = ref_station["geometry"]["coordinates"][:2]
+    nearbys = io_helper.stations_nearby(sources, lon, lat, limit=limit, radius=radius, exclude=station_id)
+    return [_with_distance(s, d) for s, d in nearbys]
 
-def _deduplicate_helper(features):
-    seen = set()
-    for x in features:
-        t = tuple(x['geometry']['coordinates'])
-        if t not in seen:
-            yield x
-            seen.add(t)
 
-def _all_stations_as_list():
+def _with_distance(s, dist):
     """
-    Concatenates the list of stations from all sources and return it as a list
-    :return:
+    Add the distance to the station
+    :param s: station feature
+    :param dist: distance to the reference station
+    :return: a copy of the feature (the original one is shared by the catalog cache), with a distance field
     """
-    features = []
-    for src_name, src in sources.items():
-        json_content = io_helper.resource_get(src, 'list')
-        features.extend(json_content['features'])
-    # # TODO: remove these 6 lines after demo
-    # print(len(features))
-    # random.shuffle(features)
-    # features_dedup = []
-    # for f in _deduplicate_helper(features):
-    #     features_dedup.append(f)
-    # print(len(features_dedup))
-    return features
-
-def _get_nearby_stations(station_id):
-    ref_station = _get_any_station(station_id)['features'][0]
-    all_stations = _all_stations_as_list()
-    # remove the ref station from list
-    all_stations.remove(ref_station)
-    #nearbys = sorted([_distance(ref_station, s) for s in all_stations], key=lambda x: x[1])
-    with_distance = [_distance(ref_station, s) for s in all_stations]
-    nearbys = sorted(with_distance, key=operator.itemgetter('distance'))
-    # print(nearbys)
-    return nearbys
-
-
-def _distance(ref, s):
-    """
-    Calculate cartesian distance between 2 stations
-    :param p0:
-    :param p1:
-    :return: a tuple (id, distance)
-    """
-    p1 = ref["geometry"]["coordinates"]
-    p2 = s["geometry"]["coordinates"]
-    dist = math.sqrt((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2)
+    s = dict(s)
     s["distance"] = dist
     return s
 